@@ -0,0 +1,127 @@
+"""
+Benchmark fetching a large batch of messages with imaplib's response
+handling versus the FetchReader, against a canned local IMAP server, both
+reading raw messages and parsing them.
+
+Usage:
+  python -m mx.bench [--messages N] [--size BYTES] [--rounds N]
+"""
+import argparse
+import re
+import socket
+import threading
+from time import perf_counter
+
+from . import message
+from .imap import IMAP, uid_set
+
+
+class CannedServer(threading.Thread):
+    """
+    Answers every UID FETCH with the same canned batch of messages.
+    """
+
+    def __init__(self, sock, messages, size):
+        super(CannedServer, self).__init__(daemon=True)
+        self.sock = sock
+
+        body = b'Subject: bench\r\n\r\n' + (b'X' * 76 + b'\r\n') * (size // 78)
+        self.fetch_response = b''.join(
+            b'* %d FETCH (UID %d BODY[] {%d}\r\n%s)\r\n' % (n, n, len(body), body)
+            for n in range(1, messages + 1))
+
+    def run(self):
+        file = self.sock.makefile('rb')
+        self.sock.sendall(b'* OK [CAPABILITY IMAP4rev1] canned\r\n')
+
+        for line in file:
+            tag, command = line.split(b' ', 2)[:2]
+            if command.upper() == b'LOGOUT':
+                self.sock.sendall(b'* BYE\r\n' + tag + b' OK\r\n')
+                break
+            if command.upper() == b'UID':
+                self.sock.sendall(self.fetch_response)
+            self.sock.sendall(tag + b' OK done\r\n')
+
+
+class LocalIMAP(IMAP):
+
+    def __init__(self, sock):
+        self._sock = sock
+        super(LocalIMAP, self).__init__('localhost')
+
+    def _create_socket(self, timeout):
+        return self._sock
+
+
+def fetch_imaplib(client, uids):
+    """
+    Fetch path before FetchReader; imaplib reads literals, regex per message.
+    """
+    _, data = client.uid('FETCH', uid_set(uids), '(UID BODY.PEEK[])')
+
+    messages = []
+    for item in data:
+        if isinstance(item, tuple):
+            _type, body = item
+            match = re.match(r'(?P<index>\d+) \(.*UID (?P<uid>\d+)', _type.decode())
+            messages.append((match.group('index'), match.group('uid'), body))
+    return messages
+
+
+def fetch_reader(client, uids):
+    return list(client._fetch_messages(uids))
+
+
+def parse_imaplib(client, uids):
+    """
+    Fetch path before StreamParser; raw message parsed once fully read.
+    """
+    return [message.parse(body) for _, _, body in fetch_imaplib(client, uids)]
+
+
+def parse_streamed(client, uids):
+    """
+    FetchReader streaming literals into a StreamParser while they're read.
+    """
+    return [parser.close() for _, _, parser in
+            client._fetch_messages(uids, parser=message.StreamParser)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark IMAP FETCH response reading')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    client_sock, server_sock = socket.socketpair()
+    CannedServer(server_sock, args.messages, args.size).start()
+
+    client = LocalIMAP(client_sock)
+    client.state = 'SELECTED'
+    uids = range(1, args.messages + 1)
+
+    print('Fetch {} messages of {} bytes, best of {} rounds'.format(
+        args.messages, args.size, args.rounds))
+
+    for name, fetch in (('imaplib', fetch_imaplib),
+                        ('FetchReader', fetch_reader),
+                        ('imaplib+parse', parse_imaplib),
+                        ('streamed', parse_streamed)):
+        best = None
+        for _ in range(args.rounds):
+            start = perf_counter()
+            assert len(fetch(client, uids)) == args.messages
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        megabytes = args.messages * args.size / 1024 / 1024
+        print('{:>13}: {:.3f}s ({:.0f} MB/s)'.format(name, best, megabytes / best))
+
+    client.state = 'AUTH'
+    client.logout()
+
+
+if __name__ == '__main__':
+    main()
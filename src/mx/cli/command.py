@@ -10,10 +10,30 @@ Options:
   -h --host <host>            IMAP host [default: imap.gmail.com]
   -u --username <username>    IMAP account username, can also be set through env IMAP_USERNAME
   -p --password <password>    IMAP account password, can also be set through env IMAP_PASSWORD
+  --no-compress               Disable IMAP COMPRESS=DEFLATE, even if supported by host
   --interval N                Check for new mail by polling every N seconds [default: 30]
+  --min-interval N            Shortest adaptive polling interval [default: 5]
+  --max-interval N            Longest adaptive polling interval [default: 300]
+  --rate-limit N              Poll host at most N times per minute [default: 12]
+  --batch-size N              Fetch at most N mails per batch [default: 20]
+  --batch-mb N                Fetch at most N megabytes of mail per batch [default: 10]
+  --prefetch N                Fetch up to N batches ahead while storing, 0 disables [default: 2]
+  --connections N             Drain mail backlog over up to N IMAP connections [default: 1]
+  --archive FOLDER            Move imported mail to FOLDER
+  --spool DIR                 Save a raw copy of each fetched mail in DIR
+  --rules FILE                Skip, move or strip mail matching header rules in FILE
+  --store-connections N       Keep up to N connections to the store alive [default: 4]
+  --store-timeout N           Store request timeout in seconds [default: 30]
+  --store-retries N           Retry failed idempotent store requests N times [default: 2]
   --subscribe                 Subscribe for new mail event instead of polling
+  --profile                   Profile import cycles with cProfile and tracemalloc, toggled by SIGUSR1
+  --profile-dir DIR           Write profile reports to DIR [default: /tmp/mx-profile]
+  --profile-cycles N          Profile N import cycles when polling [default: 10]
+  --profile-seconds N         Profile imports for N seconds when subscribed [default: 60]
+  --config FILE               Read options from JSON FILE, reloaded on SIGHUP
   --pid FILE                  Create pid file FILE [default: /tmp/mx.pid]
   --logto FILE                Log output to FILE instead of console
+  --metrics-interval N        Log metrics every N seconds, 0 only on exit [default: 300]
   -v                          Enable verbose output
   --version                   Show version
   -? --help                   Show this screen
@@ -21,16 +41,25 @@ Options:
 """
 import os
 import sys
+import json
 import logging
 import logging.config
 import signal
 
-from time import sleep
+from contextlib import contextmanager
+from functools import partial
 from getpass import getpass
+from multiprocessing import SimpleQueue
+from time import monotonic
 
 from docopt import docopt
 
-from .. import __version__, imap, message
+from .. import __version__, imap
+from ..importer import Importer
+from ..metrics import metrics
+from ..profiling import Profiler
+from ..rules import Rules, RuleError
+from ..scheduler import Scheduler
 from ..stores.errors import BackendError
 
 from . import log
@@ -43,15 +72,63 @@ class Interface(object):
 
     _quit = False
     _retry = False
+    _reload = False
+    _reloaded_at = None
+    _toggle_profiling = False
+    _deferred = False
+    _pending = False
+
+    importing = None  # Spawned import process, one at a time
+
+    rules = None
+    store = None
+    subscriber = None
+    profiler = None
+
+    # Options that need a restart to change
+    static_options = ('--pid',)
+
+    # Options parsed as numbers, and how
+    number_options = {
+        '--interval': float, '--min-interval': float, '--max-interval': float,
+        '--rate-limit': float, '--batch-size': int, '--batch-mb': float, '--prefetch': int,
+        '--connections': int, '--store-connections': int, '--store-timeout': float,
+        '--store-retries': int, '--profile-cycles': int, '--profile-seconds': float,
+        '--metrics-interval': float, '-v': int
+    }
+
+    # Options the scheduler is created from
+    scheduler_options = ('--host', '--interval', '--min-interval', '--max-interval',
+                         '--rate-limit')
 
     def __init__(self):
         # Parse command options
-        self.opts = docopt(__doc__, version='mx v{}'.format(__version__))
+        try:
+            self.opts = self.load_options()
+        except (OSError, ValueError) as e:
+            exit('Failed to read config: {}'.format(e))
 
         # Setup logging
         self.setup_logging()
         logger.info('Start mx...')
 
+        # Ensure spool directory
+        try:
+            self.prepare_spool()
+        except OSError as e:
+            exit('Failed to prepare spool: {}'.format(e))
+
+        # Load rules
+        try:
+            self.load_rules()
+        except RuleError as e:
+            exit('Failed to load rules: {}'.format(e))
+
+        # Metrics of spawned imports, reported back to us
+        self.pid = os.getpid()
+        self.reports = SimpleQueue()
+        self._reported_at = monotonic()
+
         # Main loop condition
         self._running = False
 
@@ -71,6 +148,7 @@ class Interface(object):
 
         # Start command loop
         try:
+            self._toggle_profiling = self.opts['--profile']
             self.run()
         except Exception as e:
             logger.exception(e)
@@ -79,24 +157,40 @@ class Interface(object):
 
     def run(self):
         self._running = True
+        self.scheduler = self.create_scheduler()
+        self.configure_store()
+
+        try:
+            self.loop()
+        finally:
+            self.unsubscribe()
+            self.stop_profiling()
 
+    def loop(self):
         while self._running:
             try:
+                if self._reload:
+                    self.reload()
+
+                if self._toggle_profiling:
+                    self.toggle_profiling()
+
+                self.scheduler.poll()
+
                 if self.opts['--subscribe']:
                     # MODE: Subscribe
-                    with imap.login(**self.imap_settings) as subscriber:
-                        # Blocks with callback
-                        subscriber.subscribe(self.import_mail.spawn)
+                    self.subscribe()
                 else:
                     # MODE: Polling
-                    self.import_mail()
+                    self.unsubscribe()
+                    count = self.import_mail()
+                    self.scheduler.success(count)
+                    self.resumed()
 
                     if not self._running:
                         continue  # Check for shutdown signal before sleep
 
-                    interval = self.opts['--interval']
-                    logger.debug('Sleep for %s seconds...', interval)
-                    sleep(float(interval))
+                    self.scheduler.wait(interrupted=self.interrupted)
 
             except ConnectionError as e:
                 logger.critical('Connection error: %s', e)
@@ -104,42 +198,310 @@ class Interface(object):
             except ValueError as e:
                 logger.error('IMAP error: %s', e)
                 self._retry = True
+            except BackendError as e:
+                logger.error('Backend error: %s', e)
+                self._retry = True
             except InterruptedError:
                 continue  # Interrupted by signal, re-loop
 
             if self._retry:
-                wait = 30
-                logger.debug('Retry in %s seconds...', wait)
-                sleep(wait)
+                self._retry = False
+                self.scheduler.failure()
+                logger.debug('Retry after %s failure(s)...', self.scheduler.failures)
+                self.scheduler.wait(interrupted=self.interrupted)
+
+    def subscribe(self):
+        """
+        Subscribe for new mail, keeping the IDLE session logged in between
+        subscriptions, until interrupted by a signal.
+        """
+        if self.subscriber is None:
+            self.subscriber = imap.login(keep_alive=True, **self.imap_settings)
+
+        with self.subscriber as client:
+            self.resumed()
+
+            if self._deferred or self._pending:
+                self.spawn_import()  # Circuit no longer open, or import done
+
+            # Blocks with callback, subscribed once ready
+            client.subscribe(self.spawn_import, interrupted=self.interrupted,
+                             ready=self.scheduler.reset)
+
+    def unsubscribe(self):
+        if self.subscriber is not None:
+            self.subscriber.close()
+            self.subscriber = None
+
+    def spawn_import(self):
+        """
+        Spawn an import of new mail, unless the store's circuit is open.
+        Spawned imports share the circuit breaker state with us, see
+        CircuitBreaker. A deferred import is spawned once the circuit turns
+        half-open.
+
+        Only one import runs at a time, mail stays unseen until imported, so
+        concurrent imports would import the same mail. New mail arriving
+        meanwhile is imported by a single import once the running one exits.
+        """
+        if self.importing is not None and self.importing.is_alive():
+            logger.debug('Import running, queue import of new mail')
+            metrics.incr('import.coalesced')
+            self._pending = True
+            return
+
+        self.importing = None
+        self._pending = False
+        self._deferred = not self.store.breaker.allow()
+
+        if self._deferred:
+            logger.info('Store circuit is open, defer import')
+            metrics.incr('import.deferred')
+        else:
+            self.importing = self.import_mail.spawn()
+
+    def interrupted(self):
+        """
+        Checked every second while waiting for next poll or new mail. Also
+        reports metrics when due.
+        """
+        self.report_metrics()
+
+        if self._deferred and self.store.breaker.allow():
+            return True
+        if self._pending and not self.importing.is_alive():
+            return True
+        return self._reload or self._toggle_profiling or not self._running
+
+    def toggle_profiling(self):
+        self._toggle_profiling = False
+
+        if self.profiler is not None and not self.profiler.expired():
+            self.stop_profiling()
+        elif self.opts['--subscribe']:
+            # Each spawned import profiles itself, until window ends
+            self.profiler = Profiler(self.opts['--profile-dir'],
+                                     seconds=float(self.opts['--profile-seconds']))
+            logger.info('Profile imports for %s seconds', self.opts['--profile-seconds'])
+        else:
+            self.profiler = Profiler(self.opts['--profile-dir'],
+                                     cycles=int(self.opts['--profile-cycles']))
+            logger.info('Profile %s import cycles', self.opts['--profile-cycles'])
+
+    def stop_profiling(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    @contextmanager
+    def profiling(self):
+        """
+        Profile an import cycle while profiling. A spawned import writes
+        reports of its own cycle, otherwise reports are written once the
+        configured number of cycles were profiled.
+        """
+        profiler = self.profiler
+        if profiler is None or profiler.expired():
+            yield
+            return
+
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.cycles += 1
+            if profiler.pid != os.getpid():
+                profiler.stop()
+            elif profiler.expired():
+                self.stop_profiling()
+
+    @contextmanager
+    def reporting(self):
+        """
+        Report metrics of a spawned import back to us once done, a polled
+        import counts straight into ours.
+        """
+        if os.getpid() == self.pid:
+            yield
+            return
+
+        metrics.reset()  # Inherited metrics are ours
+        try:
+            yield
+        finally:
+            self.reports.put(metrics.snapshot())
+
+    def report_metrics(self, force=False):
+        """
+        Collect metrics reported by spawned imports, and log all metrics
+        every --metrics-interval seconds, or now if forced.
+        """
+        while not self.reports.empty():
+            metrics.merge(self.reports.get())
+
+        interval = float(self.opts['--metrics-interval'])
+        if force or (interval and monotonic() - self._reported_at >= interval):
+            metrics.report()
+            self._reported_at = monotonic()
 
     @spawnable
     def import_mail(self):
-        with imap.login(**self.imap_settings) as client:
-            for index, uid, msg in client.fetch_unseen():
-                try:
-                    mail = message.parse(msg)
-                    logger.info('New mail: %s', mail.subject)
-
-                    # Insert mail into tinbox
-                    from ..stores.tinbox import insert
-                    insert(mail)
-
-                    # TODO: Submit message to remote API
-                    # TODO: Delete if successfully submitted?
-                    #       CLI option --delete?
-
-                except BackendError:
-                    logger.exception('Failed to import mail: %s', uid)
-                    client.mark_unseen(index)
-                    # TODO: Catch correct api exception
-                    # TODO: Handle failed api call, mark as unseen. Flag with
-                    #       try-count? Delete after X tries?
-
-                except Exception:
-                    logger.exception('Failed to parse mail: %s', uid)
-                    # TODO: Create custom parse exception
-                    # TODO: Handle mail parse error. Move to other mailbox?
-                    #       leave as seen?
+        with self.reporting(), self.profiling(), imap.login(**self.imap_settings) as client:
+            importer = Importer(client, self.store.insert, self.store.breaker,
+                                **self.import_settings)
+            return importer.run()
+
+    def configure_store(self):
+        """
+        Setup store in this process, authenticated once and inherited by
+        spawned imports.
+        """
+        from ..stores import tinbox
+        tinbox.configure(**self.store_settings)
+        self.store = tinbox
+
+    def load_options(self):
+        """
+        Parse command options, overridden by options in config file, if any.
+
+        Config file is a JSON object of options, named with or without
+        leading dashes, e.g. {"interval": 60, "rules": "rules.json", "-v": 1}
+
+        :raise ValueError: Unknown option, or invalid number
+        """
+        opts = docopt(__doc__, version='mx v{}'.format(__version__))
+        path = opts['--config']
+
+        if path:
+            with open(path) as f:
+                config = json.load(f)
+
+            for name, value in config.items():
+                option = name if name.startswith('-') else '--' + name
+                if option not in opts or option == '--config':
+                    raise ValueError('Unknown option {!r} in {}'.format(name, path))
+                opts[option] = value
+
+        for option, number in self.number_options.items():
+            try:
+                number(opts[option])
+            except (TypeError, ValueError):
+                raise ValueError('Option {} must be {}, got {!r}'.format(
+                    option, number.__name__, opts[option]))
+
+        return opts
+
+    def prepare_spool(self):
+        """
+        Create spool directory, if any, and ensure mail can be saved in it.
+        """
+        spool = self.opts['--spool']
+        if spool:
+            os.makedirs(spool, exist_ok=True)
+            if not os.access(spool, os.W_OK | os.X_OK):
+                raise PermissionError('Spool directory {} is not writable'.format(spool))
+
+    def load_rules(self):
+        if self.opts['--rules']:
+            self.rules = Rules.load(self.opts['--rules'])
+            logger.info('Loaded %s rule(s) from %s', len(self.rules), self.opts['--rules'])
+        else:
+            self.rules = None
+
+    def reload(self):
+        """
+        Reload options, logging, spool directory and rules in place. The
+        scheduler is only recreated, and the subscriber only reconnected, if
+        their options changed. Store settings apply to the next import.
+        Current configuration is kept if the new one fails to load.
+        """
+        self._reload = False
+        logger.info('Reload configuration...')
+
+        opts, rules = self.opts, self.rules
+        imap_settings = self.imap_settings
+
+        with metrics.timer('reload'):
+            try:
+                self.opts = self.load_options()
+                for option in self.static_options:
+                    self.opts[option] = opts[option]
+
+                self.ensure_credentials(fallback=opts)
+                self.prepare_spool()
+                self.load_rules()
+                self.configure_store()
+            except (OSError, ValueError, RuleError) as e:
+                logger.error('Failed to reload, keep current configuration: %s', e)
+                self.opts, self.rules = opts, rules
+                return
+
+            self.setup_logging()
+
+            if any(self.opts[option] != opts[option] for option in self.scheduler_options):
+                logger.info('Scheduler options changed, reset scheduler')
+                self.scheduler = self.create_scheduler()
+
+            if self.subscriber is not None and self.imap_settings != imap_settings:
+                logger.info('IMAP settings changed, reconnect subscriber')
+                metrics.incr('reload.reconnects')
+                self.unsubscribe()
+
+        self._reloaded_at = monotonic()
+
+    def resumed(self):
+        """
+        Measure time from reload until import has resumed, reconnected if needed.
+        """
+        if self._reloaded_at is not None:
+            metrics.observe('reload.resume', monotonic() - self._reloaded_at)
+            self._reloaded_at = None
+
+    def create_scheduler(self):
+        return Scheduler(host=self.opts['--host'],
+                         interval=self.opts['--interval'],
+                         min_interval=self.opts['--min-interval'],
+                         max_interval=self.opts['--max-interval'],
+                         rate_limit=self.opts['--rate-limit'])
+
+    @property
+    def import_settings(self):
+        return {
+            'batch_size': int(self.opts['--batch-size']),
+            'batch_bytes': int(float(self.opts['--batch-mb']) * 1024 * 1024),
+            'archive': self.opts['--archive'],
+            'spool': self.opts['--spool'],
+            'prefetch': int(self.opts['--prefetch']),
+            'connections': self.connections,
+            'connect': partial(imap.login, **self.imap_settings),
+            'rules': self.rules
+        }
+
+    @property
+    def store_settings(self):
+        return {
+            'pool_size': int(self.opts['--store-connections']),
+            'timeout': float(self.opts['--store-timeout']),
+            'retries': int(self.opts['--store-retries'])
+        }
+
+    @property
+    def connections(self):
+        """
+        Number of connections to drain backlog over, bounded by host's
+        session limit, less one for the subscriber's own session. Holds for
+        the account as a whole since only one import runs at a time, see
+        spawn_import.
+        """
+        connections = int(self.opts['--connections'])
+        limit = imap.SESSION_LIMITS.get(self.opts['--host'])
+
+        if limit:
+            if self.opts['--subscribe']:
+                limit -= 1
+            connections = min(connections, limit)
+
+        return max(connections, 1)
 
     @property
     def imap_settings(self):
@@ -147,7 +509,8 @@ class Interface(object):
             'host': self.opts['--host'],
             'username': self.opts['--username'],
             'password': self.opts['--password'],
-            'debug_level': self.opts['-v'] - 1
+            'debug_level': self.opts['-v'] - 1,
+            'compress': not self.opts['--no-compress']
         }
 
     def setup_logging(self):
@@ -162,10 +525,13 @@ class Interface(object):
         signal.signal(signal.SIGINT, lambda *args: self.sigint_handler())
         # 15; Stop
         signal.signal(signal.SIGTERM, lambda *args: self.sigterm_handler())
+        # 10; Toggle profiling
+        signal.signal(signal.SIGUSR1, lambda *args: self.sigusr1_handler())
 
         if catch_all:
             exclude_signals = (
                 signal.SIGHUP, signal.SIGINT, signal.SIGTERM,    # Handled by us
+                signal.SIGUSR1,                                  # Handled by us
                 signal.SIG_DFL, signal.SIGKILL, signal.SIGSTOP   # Non-catchable
             )
 
@@ -191,13 +557,20 @@ class Interface(object):
             os.remove(pidfile)
             logger.debug('Cleanup PID file: %s', pidfile)
 
-    def ensure_credentials(self):
+    def ensure_credentials(self, fallback=None):
         # Fallback missing cli args to environment vars
         if not self.opts['--username']:
             self.opts['--username'] = os.environ.get('IMAP_USERNAME')
         if not self.opts['--password']:
             self.opts['--password'] = os.environ.get('IMAP_PASSWORD')
 
+        # Keep current credentials on reload, e.g. if prompted for
+        if fallback:
+            if not self.opts['--username']:
+                self.opts['--username'] = fallback['--username']
+            if not self.opts['--password']:
+                self.opts['--password'] = fallback['--password']
+
         # Prompt for username/password if not given
         if not self.opts['--username']:
             self.opts['--username'] = input('Username: ')
@@ -212,8 +585,13 @@ class Interface(object):
 
     def sighup_handler(self):
         logger.warn('--- SIGHUP ---')
-        # Rely on process manager (e.g. supervisor) to restart
-        self.safe_quit(exit_code=1)  # nonzero exit code makes supervisor reload
+        # Reload in place, once current import or subscription is interrupted
+        self._reload = True
+
+    def sigusr1_handler(self):
+        logger.warn('--- SIGUSR1 ---')
+        # Toggle profiling, once current import or subscription is interrupted
+        self._toggle_profiling = True
 
     def sigint_handler(self):
         logger.warn('--- SIGINT ---')
@@ -236,6 +614,7 @@ class Interface(object):
 
     def quit(self):
         self.delete_pidfile()
+        self.report_metrics(force=True)
         logger.info('Bye!')
         exit(self.get_exit_code())
 
@@ -8,7 +8,7 @@ log = logging.getLogger(__name__)
 def spawnable(outer_func=None, debug=False):
     """
     Decorator to make a method a blind-firing asynchronous subprocess.
-    Spawns a subprocess of original when called.
+    Spawns a subprocess of original when called, returning its Process.
 
     >>> import time
 
@@ -44,12 +44,13 @@ def spawnable(outer_func=None, debug=False):
 
             if debug:
                 log.warning('debug is set, running inline')
-                return self.func(*args, **kwargs)
+                return self.func(self.instance, *args, **kwargs)
 
             p = Process(target=self.func,
                         args=(self.instance,) + args,
                         kwargs=kwargs)
             p.start()
+            return p
 
         def __get__(self, instance, klass):
             self.instance = instance
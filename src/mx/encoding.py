@@ -1,10 +1,13 @@
 import chardet
 
+from .profiling import profiled
+
 
 class EncodingError(Exception):
     pass
 
 
+@profiled('smart_decode')
 def smart_decode(data, charset):
     """
     Decodes data in given charset.
@@ -0,0 +1,191 @@
+import logging
+import re
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FETCH_RE = re.compile(br'\* (?P<index>\d+) FETCH \(')
+UNTAGGED_STATUS_RE = re.compile(br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?')
+UNTAGGED_RE = re.compile(br'\* (?P<type>[A-Z-]+)( (?P<data>.*))?')
+LITERAL_RE = re.compile(br'.*{(?P<size>\d+)}$')
+
+TOKEN_RE = re.compile(br'''[ ]*(?:
+    (?P<atom>[^ ()"{\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?)  # e.g. 42, \\Seen, BODY[HEADER.FIELDS (TO)]<0>
+  | (?P<open>\()
+  | (?P<close>\))
+  | "(?P<quoted>(?:[^"\\]|\\.)*)"
+  | {(?P<literal>\d+)}$
+)''', re.VERBOSE)
+QUOTED_ESCAPE_RE = re.compile(br'\\(.)')
+
+
+class FetchReader(object):
+    """
+    Reads FETCH responses straight off an IMAP connection, bypassing imaplib's
+    response handling.
+
+    Literals are read directly into a buffer preallocated from their {n}
+    length, with no intermediate copies. Message body literals can instead be
+    streamed, through one reused chunk buffer, into a sink such as
+    message.StreamParser. FETCH attributes (UID, FLAGS, RFC822.SIZE,
+    BODYSTRUCTURE, ...) are parsed into python values by a small tokenizer:
+
+        * 12 FETCH (UID 42 FLAGS (\\Seen) RFC822.SIZE 2048)
+        -> (12, {'UID': 42, 'FLAGS': [b'\\Seen'], 'RFC822.SIZE': 2048})
+
+    Example:
+    > reader = FetchReader(client)
+    > for index, attributes in reader.fetch('1:10', '(UID RFC822.SIZE)'):
+    ...     print(attributes['UID'], attributes['RFC822.SIZE'])
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, client):
+        self.client = client
+        self.chunk = None
+
+    def fetch(self, uids, items, sink=None):
+        """
+        Issue UID FETCH and yield (index, attributes) for each FETCH response.
+
+        :param uids: Message UIDs formatted as a set
+        :param items: FETCH data items, e.g. '(UID BODY.PEEK[])'
+        :param sink: Factory of objects with a feed method, body section
+                     literals are streamed into a new sink instead of read
+                     into a buffer, and the sink is returned as their value
+        """
+        client = self.client
+        tag = client._command('UID', 'FETCH', uids, items)
+
+        while True:
+            line = self.read_line()
+
+            if line.startswith(tag + b' '):
+                del client.tagged_commands[tag]
+                status, _, details = line[len(tag) + 1:].partition(b' ')
+                if status != b'OK':
+                    raise client.error('FETCH command error: {} {}'.format(
+                        status.decode(), details.decode(errors='replace')))
+                return
+
+            match = FETCH_RE.match(line)
+            if match:
+                tokenizer = Tokenizer(self, line, match.end(), sink)
+                yield int(match.group('index')), tokenizer.attributes()
+            else:
+                self.untagged(line)
+
+    def untagged(self, line):
+        """
+        Hand unsolicited responses, like EXISTS or EXPUNGE, over to imaplib.
+        """
+        match = UNTAGGED_STATUS_RE.match(line) or UNTAGGED_RE.match(line)
+        if not match:
+            raise self.client.abort('unexpected response: {!r}'.format(line))
+
+        data = match.group('data') or b''
+        if match.re is UNTAGGED_STATUS_RE and match.group('data2'):
+            data += b' ' + match.group('data2')
+
+        literal = LITERAL_RE.match(line)
+        while literal:
+            self.client._append_untagged(match.group('type').decode(),
+                                         (data, self.read_literal(int(literal.group('size')))))
+            line = data = self.read_line()
+            literal = LITERAL_RE.match(line)
+
+        self.client._append_untagged(match.group('type').decode(), data)
+        self.client._check_bye()
+
+    def read_line(self):
+        line = self.client.readline()
+        if not line:
+            raise self.client.abort('socket error: EOF')
+        return line.rstrip(b'\r\n')
+
+    def read_literal(self, size):
+        buffer = bytearray(size)
+        self.client.readinto(buffer)
+        metrics.incr('imap.fetched_bytes', size)
+        return buffer
+
+    def stream_literal(self, size, sink):
+        if self.chunk is None:
+            self.chunk = memoryview(bytearray(self.chunk_size))
+
+        remaining = size
+        while remaining:
+            view = self.chunk[:min(remaining, self.chunk_size)]
+            self.client.readinto(view)
+            sink.feed(view)
+            remaining -= len(view)
+
+        metrics.incr('imap.fetched_bytes', size)
+
+
+class Tokenizer(object):
+    """
+    Parses the attribute list of a FETCH response, continuing on the next
+    line after each literal.
+    """
+
+    def __init__(self, reader, line, pos, sink=None):
+        self.reader = reader
+        self.line = line
+        self.pos = pos
+        self.sink = sink
+
+    def attributes(self):
+        """
+        Parse "name value name value ...)" into a dict, names upper cased.
+        """
+        values = self.list(top=True)
+        return dict(zip((name.decode().upper() for name in values[::2]), values[1::2]))
+
+    @staticmethod
+    def is_section(name):
+        name = name.upper()
+        return name.startswith((b'BODY[', b'BINARY[')) or name in (b'RFC822', b'RFC822.TEXT')
+
+    def list(self, top=False):
+        values = []
+
+        while True:
+            match = TOKEN_RE.match(self.line, self.pos)
+            if not match:
+                raise self.reader.client.abort('unexpected FETCH response: {!r}'.format(self.line))
+
+            self.pos = match.end()
+            kind = match.lastgroup
+
+            if kind == 'atom':
+                atom = match.group('atom')
+                if atom.isdigit():
+                    atom = int(atom)
+                elif atom.upper() == b'NIL':
+                    atom = None
+                values.append(atom)
+            elif kind == 'close':
+                return values
+            elif kind == 'open':
+                values.append(self.list())
+            elif kind == 'quoted':
+                values.append(QUOTED_ESCAPE_RE.sub(br'\1', match.group('quoted')))
+            else:
+                # Literal value of a body section is streamed into sink
+                section = top and len(values) % 2 and self.is_section(values[-1])
+                values.append(self.literal(int(match.group('literal')), section))
+
+    def literal(self, size, section):
+        if section and self.sink:
+            value = self.sink()
+            self.reader.stream_literal(size, value)
+        else:
+            value = self.reader.read_literal(size)
+
+        # Response continues on next line
+        self.line = self.reader.read_line()
+        self.pos = 0
+        return value
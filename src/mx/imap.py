@@ -1,14 +1,194 @@
 import imaplib
 import logging
-import re
+import zlib
 from contextlib import contextmanager, ExitStack
 from select import select
 
+from .fetch import FetchReader
+from .metrics import metrics
+
 logger = logging.getLogger(__name__)
 
+# Concurrent IMAP sessions allowed per account, by host
+SESSION_LIMITS = {
+    'imap.gmail.com': 15,
+}
+
+
+def uid_set(uids):
+    """
+    Format UIDs as a compact IMAP set, e.g. [1, 2, 3, 5] -> '1:3,5'
+    """
+    uids = sorted(set(int(uid) for uid in uids))
+    ranges = []
+
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ','.join(str(first) if first == last else '{}:{}'.format(first, last)
+                    for first, last in ranges)
+
+
+def split_batches(sizes, batch_size, batch_bytes):
+    """
+    Split (uid, size) tuples into batches of UIDs, bounded by number
+    of messages and total size. A message larger than <batch_bytes> ends
+    up alone in its own batch.
+    """
+    batch, total = [], 0
+
+    for uid, size in sizes:
+        if batch and (len(batch) >= batch_size or total + size > batch_bytes):
+            yield batch
+            batch, total = [], 0
+
+        batch.append(uid)
+        total += size
+
+    if batch:
+        yield batch
+
+
+class DeflateFile(object):
+    """
+    Read-only file-like object inflating a raw DEFLATE stream (RFC 4978)
+    received on socket. Replaces the socket file imaplib reads from.
+    """
+
+    chunk_size = 16384
+
+    def __init__(self, sock, file):
+        self.sock = sock
+        self.file = file  # Original socket file, closed along with us
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def pending(self):
+        """
+        Inflated bytes, or decrypted TLS bytes, are waiting to be read.
+        A select() on the socket alone would not notice them.
+        """
+        pending = getattr(self.sock, 'pending', None)
+        return bool(self.buffer) or bool(pending and pending())
+
+    def _fill(self):
+        data = self.sock.recv(self.chunk_size)
+        if not data:
+            return False  # EOF
+
+        inflated = self.inflater.decompress(data)
+        self.buffer += inflated
+
+        metrics.incr('imap.deflate.wire_bytes_in', len(data))
+        metrics.incr('imap.deflate.bytes_in', len(inflated))
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self._fill():
+            pass
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readinto(self, buffer):
+        while not self.buffer and self._fill():
+            pass
+
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+    def readline(self, limit=-1):
+        while True:
+            end = self.buffer.find(b'\n') + 1
+            if end or 0 <= limit <= len(self.buffer) or not self._fill():
+                break
+
+        if not end or 0 <= limit < end:
+            end = len(self.buffer) if limit < 0 else min(limit, len(self.buffer))
+
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def close(self):
+        self.file.close()
+
 
 class IMAP(imaplib.IMAP4_SSL):
 
+    _deflater = None
+
+    def compress(self):
+        """
+        Enable RFC 4978 COMPRESS=DEFLATE, every byte read and written from
+        here on is transparently inflated/deflated.
+        """
+        if 'COMPRESS' not in imaplib.Commands:
+            imaplib.Commands['COMPRESS'] = ('AUTH', 'SELECTED')
+
+        logger.debug('IMAP: compress')
+        status, (details,) = self._simple_command('COMPRESS', 'DEFLATE')
+        if status != 'OK':
+            raise self.error(details)
+
+        self.file = DeflateFile(self.sock, self.file)
+        self._deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+
+    def send(self, data):
+        if self._deflater:
+            metrics.incr('imap.deflate.bytes_out', len(data))
+            data = self._deflater.compress(data) + self._deflater.flush(zlib.Z_SYNC_FLUSH)
+            metrics.incr('imap.deflate.wire_bytes_out', len(data))
+        else:
+            metrics.incr('imap.plain.bytes_out', len(data))
+
+        super(IMAP, self).send(data)
+
+    def read(self, size):
+        data = super(IMAP, self).read(size)
+        if not self._deflater:
+            metrics.incr('imap.plain.bytes_in', len(data))
+        return data
+
+    def readinto(self, buffer):
+        """
+        Read exactly len(buffer) bytes from remote, straight into buffer.
+        """
+        view = memoryview(buffer)
+        size = len(view)
+
+        while view:
+            read = self.file.readinto(view)
+            if not read:
+                raise self.abort('socket error: EOF')
+            view = view[read:]
+
+        if not self._deflater:
+            metrics.incr('imap.plain.bytes_in', size)
+
+    def readline(self):
+        line = super(IMAP, self).readline()
+        if not self._deflater:
+            metrics.incr('imap.plain.bytes_in', len(line))
+        return line
+
+    def _pending(self):
+        pending = getattr(self.file, 'pending', None)
+        return bool(pending and pending())
+
     @contextmanager
     def mailbox(self, name, readonly=False):
         """
@@ -28,15 +208,21 @@ class IMAP(imaplib.IMAP4_SSL):
                 logger.debug('IMAP: close mailbox [%s]', name)
                 self.close()
 
-    def subscribe(self, callback, mailbox='INBOX'):
+    def subscribe(self, callback, mailbox='INBOX', interrupted=None, ready=None):
         """
         Subscribes (blocking) for new mail events using IDLE mode.
         Notifying callback when found.
+
+        :param interrupted: Callable, returns once it returns true, see idle
+        :param ready: Callable, called once mailbox is selected
         """
         with self.mailbox(mailbox, readonly=True):
             count = self._get_exists_response()
 
-            for _ in self.idle():
+            if ready:
+                ready()
+
+            for _ in self.idle(interrupted=interrupted):
                 new_count = self._get_exists_response()
 
                 if new_count:
@@ -48,46 +234,170 @@ class IMAP(imaplib.IMAP4_SSL):
                     if expunge is not None:
                         count = expunge
 
-    def fetch_unseen(self, mailbox='INBOX', touch=True):
+    def fetch_unseen(self, mailbox='INBOX', touch=True, batch_size=20, batch_bytes=10485760,
+                     parser=None):
         """
         Selecting and searching mailbox for unseen mails.
-        Yields raw messages together with their mailbox sequence number and UID.
-
-        :param touch: Flag found messages as seen
+        Yields batches of raw messages together with their mailbox sequence
+        number and UID, smallest messages first.
+
+        Given a parser factory, each message is instead fed to a new parser
+        while it's downloaded, and the parser is yielded in place of the raw
+        message.
+
+        Messages are fetched with BODY.PEEK[] and stay unseen until they are
+        acknowledged. Only one batch is fetched at a time, the next one is not
+        fetched until the consumer asks for it.
+
+        :param touch: Open mailbox writable, needed to acknowledge messages
+        :param batch_size: Max number of messages per batch
+        :param batch_bytes: Max total size of messages per batch,
+                            larger messages are fetched one by one
+        :param parser: Incremental parser factory, e.g. message.StreamParser
         """
         with self.mailbox(mailbox, readonly=(not touch)):
-            criteria = '(UNSEEN)'
-            logger.debug('IMAP: search %s', criteria)
-            _, (result,) = self.search(None, criteria)
+            for batch in self.fetch_batches(self.search_unseen(), batch_size, batch_bytes, parser):
+                yield batch
 
-            if result:
-                indices = b','.join(result.split())  # Message sequence number formatted
-                logger.debug('IMAP: fetch messages [%s]', indices.decode())
-                _, data = self.fetch(indices, '(UID RFC822)')
+    def search_unseen(self):
+        """
+        Search selected mailbox for unseen mails.
+
+        :return: List of UIDs
+        """
+        criteria = '(UNSEEN)'
+        logger.debug('IMAP: search %s', criteria)
+        _, (result,) = self.uid('SEARCH', None, criteria)
+
+        return [int(uid) for uid in result.split()]
 
-                for _type, RFC822 in data[::2]:
-                    match = re.match(r'(?P<index>\d+) \(UID (?P<uid>\d+).*', _type.decode())
+    def fetch_batches(self, uids, batch_size=20, batch_bytes=10485760, parser=None,
+                      sizes=None):
+        """
+        Fetch messages from selected mailbox in batches, smallest first.
+        See fetch_unseen.
+
+        :param sizes: (uid, size) tuples of uids, when already fetched
+        """
+        if uids:
+            if sizes is None:
+                sizes = self.fetch_sizes(uids)
+            sizes = sorted(sizes, key=lambda uid_size: uid_size[1])
 
-                    index = match.group('index')
-                    uid = match.group('uid')
+            for batch in split_batches(sizes, batch_size, batch_bytes):
+                yield list(self._fetch_messages(batch, parser))
 
-                    logger.debug('IMAP: fetched message #%s [UID:%s]', index, uid)
-                    yield index, uid, RFC822
+    def fetch_sizes(self, uids):
+        """
+        Fetch message sizes.
 
-    def mark_unseen(self, indices):
+        :param uids: Message UIDs
+        :return: List of (uid, size) tuples
         """
-        Flag message(s) as unseen.
+        uids = uid_set(uids)
+        logger.debug('IMAP: fetch sizes [UID:%s]', uids)
+
+        return [(attributes['UID'], attributes['RFC822.SIZE'])
+                for _, attributes in FetchReader(self).fetch(uids, '(UID RFC822.SIZE)')
+                if 'RFC822.SIZE' in attributes]
+
+    def fetch_headers(self, uids, fields):
+        """
+        Fetch message sizes together with some of their header fields,
+        without flagging messages seen.
+
+        :param uids: Message UIDs
+        :param fields: Header field names, e.g. ['FROM', 'SUBJECT']
+        :return: List of (uid, size, raw header fields) tuples
+        """
+        uids = uid_set(uids)
+        section = 'BODY.PEEK[HEADER.FIELDS ({})]'.format(' '.join(fields).upper())
+        logger.debug('IMAP: fetch headers [UID:%s] %s', uids, section)
+
+        headers = []
+        for _, attributes in FetchReader(self).fetch(uids, '(UID RFC822.SIZE {})'.format(section)):
+            if 'RFC822.SIZE' not in attributes:
+                continue  # Unsolicited flag update
+
+            data = next((value for name, value in attributes.items()
+                         if name.startswith('BODY[HEADER')), b'')
+            headers.append((attributes['UID'], attributes['RFC822.SIZE'], data))
+
+        return headers
+
+    def _fetch_messages(self, uids, parser=None):
+        """
+        Fetch messages, each literal is read into a buffer of its own size or,
+        given a parser factory, streamed into a new parser while it's read.
+        """
+        uids = uid_set(uids)
+        logger.debug('IMAP: fetch messages [UID:%s]', uids)
+
+        for index, attributes in FetchReader(self).fetch(uids, '(UID BODY.PEEK[])', sink=parser):
+            if 'BODY[]' not in attributes:
+                continue  # Unsolicited flag update
+
+            uid = attributes['UID']
+
+            logger.debug('IMAP: fetched message #%s [UID:%s]', index, uid)
+            yield str(index), str(uid), attributes['BODY[]']
+
+    def acknowledge(self, uids):
+        """
+        Flag message(s) as seen in one round trip.
+
+        :param uids: Message UIDs
+        """
+        uids = uid_set(uids)
+        logger.debug('IMAP: acknowledge [UID:%s]', uids)
+        status, (details,) = self.uid('STORE', uids, '+FLAGS.SILENT', '(\\Seen)')
+        if status != 'OK':
+            raise self.error(details)
+
+        metrics.incr('imap.acknowledged')
 
-        :param indices: Message sequence number(s) in format: 2,10:12,15 means 2,10,11,12,15
+    def move(self, uids, mailbox):
         """
-        self.store(indices, '-FLAGS.SILENT', '\\Seen')
+        Move message(s) to another mailbox. Falls back to COPY, flag as
+        deleted and UID EXPUNGE when server lacks MOVE support. Without
+        UIDPLUS, copied messages are left flagged as deleted, since a plain
+        EXPUNGE would remove every deleted message in the mailbox.
 
-    def idle(self, timeout=29*60):
+        :param uids: Message UIDs formatted as a set
+        :param mailbox: Name of target mailbox
+        """
+        logger.debug('IMAP: move [UID:%s] to [%s]', uids, mailbox)
+
+        if 'MOVE' in self.capabilities:
+            status, (details,) = self.uid('MOVE', uids, mailbox)
+            if status != 'OK':
+                raise self.error(details)
+        else:
+            status, (details,) = self.uid('COPY', uids, mailbox)
+            if status != 'OK':
+                raise self.error(details)
+
+            status, (details,) = self.uid('STORE', uids, '+FLAGS.SILENT', '(\\Deleted)')
+            if status != 'OK':
+                raise self.error(details)
+
+            if 'UIDPLUS' in self.capabilities:
+                self.uid('EXPUNGE', uids)
+            else:
+                logger.warning('IMAP: no UIDPLUS support, leave [UID:%s] flagged as deleted '
+                               'in mailbox', uids)
+                metrics.incr('imap.unexpunged')
+
+        metrics.incr('imap.moved')
+
+    def idle(self, timeout=29*60, interrupted=None):
         """
         Enters IDLE mode and yields lines sent from server.
         Closes and re-enters IDLE mode every <timeout> second.
 
         :param timeout: IMAP4 RFC says restart IDLE every 29 min
+        :param interrupted: Callable, checked every second while idle,
+                            leaves IDLE mode and stops once it returns true
         """
         while 1:
             try:
@@ -98,8 +408,8 @@ class IMAP(imaplib.IMAP4_SSL):
                 idling = True
 
                 while idling:
-                    ready, _, _ = select([self.file], [], [], select_timeout)
-                    # ready = True
+                    # Compressed/encrypted bytes may already be buffered
+                    ready = self._pending() or select([self.file], [], [], select_timeout)[0]
 
                     if ready:
                         # Socket got bytes to read
@@ -107,6 +417,9 @@ class IMAP(imaplib.IMAP4_SSL):
                         self._check_bye()
                         if response:
                             yield response
+                    elif interrupted and interrupted():
+                        logger.debug('IMAP: idle interrupted')
+                        return
                     else:
                         # Timeout
                         timer += select_timeout
@@ -166,12 +479,19 @@ class login(object):
     Connect, login and returns client.
     Cleanups states and resources on exit.
     """
-    def __init__(self, host, username, password, debug_level=0):
+    def __init__(self, host, username, password, debug_level=0, compress=True,
+                 keep_alive=False):
+        """
+        :param keep_alive: Keep client logged in on a clean exit, to be
+                           reused on next enter, until closed
+        """
         self.client = None
         self.host = host
         self.username = username
         self.password = password
         self.debug = debug_level
+        self.compress = compress
+        self.keep_alive = keep_alive
 
     def __enter__(self):
         with ExitStack() as stack:  # Ensures __exit__ is called
@@ -180,20 +500,47 @@ class login(object):
             # Create IMAP client and connect
             if not self.client:
                 logger.debug('IMAP: connect [%s]', self.host)
-                self.client = IMAP(host=self.host)
+                with metrics.timer('imap.connect'):
+                    self.client = IMAP(host=self.host)
                 self.client.debug = self.debug
 
             # Login
             if self.client.state == 'NONAUTH':
                 logger.debug('IMAP: login [%s]', self.username)
-                self.client.login(self.username, self.password)
+                with metrics.timer('imap.login'):
+                    self.client.login(self.username, self.password)
+
+                    # Servers may advertise more capabilities once authenticated
+                    self.client._get_capabilities()
+
+                    if self.compress and 'COMPRESS=DEFLATE' in self.client.capabilities:
+                        self.client.compress()
+                        metrics.incr('imap.deflate.sessions')
+                    else:
+                        metrics.incr('imap.plain.sessions')
 
             stack.pop_all()
 
             return self.client
 
     def __exit__(self, exception, message, stacktrace):
-        # Cleanup
+        if exception or not self.keep_alive:
+            self.close()
+
+        if exception:
+            if exception is InterruptedError:
+                pass  # Do not handle as standard OSError -> Bubble
+
+            elif issubclass(exception, (OSError, IMAP.abort)):
+                raise ConnectionError(message)  # Merge network errors and IMAP aborts
+
+            elif issubclass(exception, IMAP.error):
+                raise ValueError(message)  # TODO: Better alternative
+
+    def close(self):
+        """
+        Logout and disconnect client, if any.
+        """
         if self.client:
             # Logout
             if self.client.state == 'AUTH':
@@ -206,13 +553,3 @@ class login(object):
                 self.client.shutdown()
 
             self.client = None
-
-        if exception:
-            if exception is InterruptedError:
-                pass  # Do not handle as standard OSError -> Bubble
-
-            elif issubclass(exception, (OSError, IMAP.abort)):
-                raise ConnectionError(message)  # Merge network errors and IMAP aborts
-
-            elif issubclass(exception, IMAP.error):
-                raise ValueError(message)  # TODO: Better alternative
@@ -0,0 +1,519 @@
+import logging
+import os
+import queue
+import threading
+from contextlib import ExitStack
+from functools import partial
+
+from . import imap, message, profiling
+from .metrics import metrics
+from .stores.errors import BackendError, CircuitOpenError, ContentError
+
+logger = logging.getLogger(__name__)
+
+DONE = object()
+
+
+def split_shards(uids, count):
+    """
+    Split UIDs into count contiguous shards of near equal size, keeping
+    each shard a compact UID set.
+    """
+    uids = sorted(uids)
+    size, extra = divmod(len(uids), count)
+    shards, start = [], 0
+
+    for n in range(count):
+        end = start + size + (n < extra)
+        shards.append(uids[start:end])
+        start = end
+
+    return shards
+
+
+class Importer(object):
+    """
+    Imports unseen mail from an IMAP client into a store.
+
+    Mail flows fetch -> parse -> store one batch at a time. The next batch is
+    not fetched until the current one is stored, keeping in-flight memory
+    bounded by the batch limits. With prefetch, up to that many batches are
+    fetched ahead by a thread while the current one is stored. Batches are
+    ordered smallest mail first, letting small mails through while huge ones
+    wait for their turn.
+
+    Mail is parsed while it's downloaded. A raw copy is only kept when a spool
+    directory is given, to save it in.
+
+    Mail is fetched without being flagged seen, and each batch is acknowledged
+    with a single UID STORE once stored, so IMAP round trips grow with the
+    number of batches rather than the number of mails.
+
+    Fetching pauses as soon as the store's circuit breaker opens, leaving the
+    remaining mail unseen for a later cycle.
+
+    Given rules, mail is filtered on its headers before it's downloaded, see
+    apply_rules.
+
+    Given a connect factory and more than one connection, a backlog is
+    drained by fetching shards of it in parallel, see run_sharded.
+
+    Example:
+    > with imap.login(...) as client:
+    ...     Importer(client, tinbox.insert, tinbox.breaker).run()
+    """
+
+    wait_interval = 1.0  # Seconds between checks for dead prefetchers
+
+    def __init__(self, client, insert, breaker, batch_size=20, batch_bytes=10485760,
+                 archive=None, spool=None, prefetch=0, connections=1, connect=None,
+                 rules=None):
+        self.client = client
+        self.insert = insert
+        self.breaker = breaker
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.archive = archive
+        self.spool = spool
+        self.prefetch = prefetch
+        self.connections = connections
+        self.connect = connect
+        self.rules = rules
+
+        self.paused = False
+        self.strip = set()  # UIDs to import without attachments
+
+    def run(self):
+        """
+        Run one import cycle.
+
+        :return: Number of fetched mails
+        :raise CircuitOpenError: Import was paused by an open circuit
+        """
+        count = 0
+
+        if self.breaker.allow():
+            if self.connections > 1 and self.connect:
+                count = self.run_sharded()
+            elif self.prefetch:
+                count = self.run_prefetched()
+            else:
+                count = self.run_serial()
+
+        if not self.breaker.allow():
+            self.paused = True
+            metrics.incr('import.paused')
+            raise CircuitOpenError('Import paused, backend circuit is open')
+
+        return count
+
+    def run_serial(self):
+        count = 0
+        batches = self.fetch()
+
+        try:
+            for batch in batches:
+                count += len(batch)
+                self.import_batch(batch)
+
+                if not self.breaker.allow():
+                    break  # Pause fetching
+        finally:
+            batches.close()  # Closes mailbox
+
+        return count
+
+    def run_prefetched(self):
+        """
+        Import batches while a prefetcher thread fetches the next ones,
+        running acknowledgements on the prefetcher's connection.
+        """
+        batches = queue.Queue(maxsize=self.prefetch)
+        prefetcher = Prefetcher(self.client, self.fetch_batches, batches)
+
+        return self.run_fetchers([prefetcher], batches)
+
+    def run_sharded(self):
+        """
+        Drain a backlog of unseen mail over several connections.
+
+        Unseen UIDs are split into shards, one per connection, each fetched
+        by a prefetcher of its own into the same queue. Extra connections are
+        only opened when there's more than a batch of mail per connection.
+        """
+        with self.client.mailbox('INBOX', readonly=True):
+            uids = self.client.search_unseen()
+
+        shards = min(self.connections, -(-len(uids) // self.batch_size))
+
+        with ExitStack() as stack:
+            clients = [self.client]
+
+            for _ in range(shards - 1):
+                connection = self.connect()
+                try:
+                    clients.append(connection.__enter__())
+                except (ConnectionError, ValueError) as e:
+                    logger.warning('Failed to open shard connection: %s', e)
+                    break
+
+                stack.callback(self.disconnect, connection)
+
+            metrics.gauge('import.shards', len(clients))
+            batches = queue.Queue(maxsize=max(self.prefetch, 1) * len(clients))
+            prefetchers = [Prefetcher(client, partial(self.fetch_batches, uids=shard), batches,
+                                      name='shard-{}'.format(n))
+                           for n, (client, shard) in enumerate(
+                               zip(clients, split_shards(uids, len(clients))))]
+
+            return self.run_fetchers(prefetchers, batches)
+
+    def disconnect(self, connection):
+        """
+        Close a shard connection. Failing to log out of a dead one is logged,
+        it must not fail the cycle once its shard's outcome is settled.
+        """
+        try:
+            connection.__exit__(None, None, None)
+        except (OSError, imap.IMAP.abort, imap.IMAP.error) as e:
+            logger.warning('Failed to close shard connection: %s', e)
+            metrics.incr('import.shard_close_errors')
+
+    def run_fetchers(self, prefetchers, batches):
+        """
+        Import batches from prefetchers until all are done, acknowledging
+        each batch through the prefetcher it came from.
+
+        A failed prefetcher leaves the rest of its shard unseen for a later
+        cycle, its checkpoint of stored but unacknowledged mail is then
+        acknowledged through another connection. Only raises when all failed.
+        """
+        count = 0
+        running = set(prefetchers)
+
+        for prefetcher in prefetchers:
+            prefetcher.start()
+
+        try:
+            while running and self.breaker.allow():  # Pause fetching when open
+                try:
+                    with metrics.timer('import.wait_fetch'):
+                        prefetcher, batch = batches.get(timeout=self.wait_interval)
+                except queue.Empty:
+                    # A prefetcher that died without a word has nothing more to put
+                    running = set(p for p in running if p.is_alive())
+                    continue
+
+                if batch is DONE:
+                    running.discard(prefetcher)
+                elif isinstance(batch, Exception):
+                    logger.error('Fetch failed on %s: %s', prefetcher.name, batch)
+                    metrics.incr('import.fetch_errors')
+                    running.discard(prefetcher)
+                else:
+                    metrics.gauge('import.prefetched', batches.qsize())
+                    count += len(batch)
+                    self.import_batch(batch, prefetcher)
+        finally:
+            for prefetcher in prefetchers:
+                prefetcher.stop()
+
+        failed = [p for p in prefetchers if p.error is not None]
+        if len(failed) == len(prefetchers):
+            raise failed[0].error
+
+        for prefetcher in failed:
+            self.recover(prefetcher, prefetchers)
+
+        return count
+
+    def recover(self, failed, prefetchers):
+        """
+        Acknowledge a failed prefetcher's checkpoint on a healthy connection,
+        so stored mail isn't imported again.
+        """
+        if not failed.checkpoint:
+            return
+
+        client = next(p.client for p in prefetchers if p.error is None)
+        logger.info('Recover checkpoint of %s: %s', failed.name, imap.uid_set(failed.checkpoint))
+
+        with client.mailbox(failed.mailbox):
+            client.acknowledge(failed.checkpoint)
+
+        metrics.incr('import.recovered', len(failed.checkpoint))
+        failed.checkpoint.clear()
+
+    def fetch(self):
+        with self.client.mailbox('INBOX'):
+            yield from self.fetch_batches(self.client)
+
+    def fetch_batches(self, client, uids=None):
+        """
+        Fetch batches of unseen mail, or of given UIDs, from selected mailbox.
+        """
+        return profiling.iterate('fetch_unseen', self._fetch_batches(client, uids))
+
+    def _fetch_batches(self, client, uids):
+        if uids is None:
+            uids = client.search_unseen()
+
+        sizes = None
+        if self.rules and uids:
+            sizes = self.apply_rules(client, uids)
+            uids = [uid for uid, _ in sizes]
+
+        yield from client.fetch_batches(uids, batch_size=self.batch_size,
+                                        batch_bytes=self.batch_bytes,
+                                        parser=self.parser, sizes=sizes)
+
+    def apply_rules(self, client, uids):
+        """
+        Match rules against header fields of mail, fetched together with
+        their sizes. Skipped mail is flagged seen and moved mail moved, both
+        in one round trip per action, without being downloaded.
+
+        :return: (uid, size) tuples of mail to import
+        """
+        if self.rules.headers:
+            headers = client.fetch_headers(uids, self.rules.headers)
+        else:
+            headers = [(uid, size, b'') for uid, size in client.fetch_sizes(uids)]
+
+        sizes = []
+        skipped = []
+        moved = {}
+
+        for uid, size, data in headers:
+            try:
+                rule = self.rules.match(data, size)
+            except Exception:
+                logger.exception('Failed to match rules: %s', uid)
+                rule = None
+
+            if rule is None:
+                sizes.append((uid, size))
+                continue
+
+            logger.debug('Rule %s matched mail: %s', rule.name, uid)
+            if rule.action == 'skip':
+                skipped.append(uid)
+            elif rule.action == 'move':
+                moved.setdefault(rule.folder, []).append(uid)
+            else:
+                self.strip.add(str(uid))
+                sizes.append((uid, size))
+
+        if skipped:
+            client.acknowledge(skipped)
+            metrics.incr('import.skipped', len(skipped))
+
+        for folder, folder_uids in sorted(moved.items()):
+            client.move(imap.uid_set(folder_uids), folder)
+            metrics.incr('import.moved', len(folder_uids))
+
+        return sizes
+
+    def parser(self):
+        return message.StreamParser(keep_raw=bool(self.spool))
+
+    def import_batch(self, batch, client=None):
+        """
+        Parse and store a batch of mails, then acknowledge the outcome.
+
+        Imported mails, and mails that can't be parsed or made into a ticket,
+        are flagged seen in one round trip; imported mails are then moved to the archive mailbox,
+        if any. Mails the store failed to import are left unseen for retry.
+
+        :param client: Client, or prefetcher, the batch was fetched with
+        """
+        client = client or self.client
+        imported = []
+        rejected = []
+
+        for index, uid, parser in batch:
+            metrics.incr('import.fetched')
+            try:
+                with profiling.stage('message.parse'):
+                    mail = parser.close()
+            except Exception:
+                logger.exception('Failed to parse mail: %s', uid)
+                metrics.incr('import.parse_errors')
+                # TODO: Handle mail parse error. Move to other mailbox?
+                rejected.append(uid)
+                continue
+            finally:
+                if self.spool:
+                    self.save_raw(uid, parser.raw)
+
+            if uid in self.strip:
+                self.strip.discard(uid)
+                mail.strip_attachments()
+
+            logger.info('New mail: %s', mail.subject)
+
+            try:
+                # Insert mail into store
+                with profiling.stage('insert'):
+                    self.insert(mail)
+                metrics.incr('import.inserted')
+                imported.append(uid)
+
+            except ContentError as e:
+                logger.error('Failed to make ticket of mail %s: %s', uid, e)
+                metrics.incr('import.content_errors')
+                rejected.append(uid)
+
+            except CircuitOpenError:
+                logger.debug('Circuit open, skip mail: %s', uid)
+                metrics.incr('import.shed')
+
+            except BackendError:
+                logger.exception('Failed to import mail: %s', uid)
+                metrics.incr('import.backend_errors')
+
+        if imported or rejected:
+            client.acknowledge(imported + rejected)
+
+        if imported and self.archive:
+            client.move(imap.uid_set(imported), self.archive)
+
+    def save_raw(self, uid, raw):
+        """
+        Save a raw copy of mail in the spool directory. Failing to do so,
+        e.g. with a full disk, is logged but doesn't stop the import.
+        """
+        path = os.path.join(self.spool, '{}.eml'.format(uid))
+        logger.debug('Spool mail: %s', path)
+        try:
+            with open(path, 'wb') as f:
+                f.write(raw)
+        except OSError as e:
+            logger.error('Failed to spool mail %s: %s', uid, e)
+            metrics.incr('import.spool_errors')
+
+
+class Prefetcher(threading.Thread):
+    """
+    Fetches batches ahead of the importer, in a thread of its own.
+
+    Fetched batches are put on a bounded queue, shared with the consumer, as
+    (prefetcher, batch) tuples, followed by (prefetcher, DONE) or, on
+    failure, (prefetcher, exception).
+
+    The IMAP connection is only ever used from this thread. Commands, like
+    acknowledgements, are submitted back to it and run in order between
+    fetches, until the consumer stops it. It stands in for the client in
+    Importer.import_batch, with acknowledge and move submitting commands.
+
+    UIDs submitted for acknowledgement are kept in a checkpoint until the
+    acknowledgement succeeded, so mail that was stored but not acknowledged
+    when the connection failed can be acknowledged on another one.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, client, fetch, batches, mailbox='INBOX', name=None):
+        """
+        :param client: IMAP client, owned by this thread until stopped
+        :param fetch: Callable taking client and returning an iterator of batches
+        :param batches: Bounded queue to put fetched batches on
+        :param mailbox: Mailbox kept selected while fetching and serving commands
+        :param name: Thread name, e.g. shard-1
+        """
+        super(Prefetcher, self).__init__(name=name, daemon=True)
+        self.client = client
+        self.fetch = fetch
+        self.batches = batches
+        self.mailbox = mailbox
+        self.commands = queue.Queue()
+        self.stopping = threading.Event()
+        self.done = False
+        self.error = None
+        self.checkpoint = set()
+
+    def run(self):
+        try:
+            with self.client.mailbox(self.mailbox):
+                try:
+                    for batch in self.fetch(self.client):
+                        if not self.put(batch):
+                            break
+
+                    self.put(DONE)
+                except Exception as e:
+                    self.fail(e)
+
+                # Keep serving acknowledgements for already fetched batches
+                self.serve()
+
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error):
+        logger.debug('Prefetch failed: %s', error)
+        if self.error is None:
+            self.error = error
+            # Submitted commands would likely fail as well, before it's put
+            self.put(error, commands=False)
+
+    def put(self, item, commands=True):
+        """
+        Put item on queue, running submitted commands while it's full.
+
+        :param commands: Run submitted commands while waiting
+        :return: False if stopped before there was room for it
+        """
+        while True:
+            if commands:
+                self.run_commands(block=False)
+            if self.stopping.is_set():
+                return False
+
+            try:
+                self.batches.put((self, item), timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+
+    def serve(self):
+        """
+        Run submitted commands until stopped.
+        """
+        while not self.done:
+            self.run_commands(block=True)
+
+    def run_commands(self, block):
+        while not self.done:
+            try:
+                command = self.commands.get(block=block)
+            except queue.Empty:
+                return
+
+            if command is DONE:
+                self.done = True
+            else:
+                func, args = command
+                func(*args)
+
+    def submit(self, func, *args):
+        self.commands.put((func, args))
+
+    def acknowledge(self, uids):
+        self.checkpoint.update(uids)
+        self.submit(self._acknowledge, uids)
+
+    def _acknowledge(self, uids):
+        self.client.acknowledge(uids)
+        self.checkpoint.difference_update(uids)
+
+    def move(self, uids, mailbox):
+        self.submit(self.client.move, uids, mailbox)
+
+    def stop(self):
+        """
+        Stop fetching and wait for submitted commands to run.
+        """
+        self.stopping.set()
+        self.commands.put(DONE)
+        self.join()
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from email import message_from_bytes
+from email.feedparser import FeedParser
 from email.headerregistry import Address, AddressHeader, SingleAddressHeader
 from email.message import MIMEPart
 from email.policy import default as email_policy
@@ -20,6 +21,53 @@ def parse(data):
     return message_from_bytes(data, policy=email_policy, _class=MIMEMessage)
 
 
+class StreamParser(object):
+    """
+    Incremental parser, fed with raw message chunks (bytes or any buffer,
+    e.g. memoryview) as they are downloaded. Close it to get the parsed
+    MailMessage.
+
+    Example:
+    > parser = StreamParser()
+    > for chunk in chunks:
+    ...     parser.feed(chunk)
+    > mail = parser.close()
+    """
+
+    def __init__(self, keep_raw=False):
+        """
+        :param keep_raw: Keep a copy of the raw message, available as .raw once closed
+        """
+        self.parser = FeedParser(policy=email_policy, _factory=MIMEMessage)
+        self.chunks = [] if keep_raw else None
+        self.raw = None
+        self.size = 0
+        self.error = None
+
+    def feed(self, data):
+        self.size += len(data)
+
+        if self.chunks is not None:
+            self.chunks.append(bytes(data))
+
+        if self.error is None:
+            try:
+                # Decode like BytesFeedParser, but straight from any buffer
+                self.parser.feed(str(data, 'ascii', 'surrogateescape'))
+            except Exception as e:
+                self.error = e  # Raised on close, keep swallowing the stream
+
+    def close(self):
+        if self.chunks is not None:
+            self.raw = b''.join(self.chunks)
+            self.chunks = None
+
+        if self.error is not None:
+            raise self.error
+
+        return self.parser.close()
+
+
 Attachment = namedtuple('Attachment', ('id', 'content_type', 'encoding', 'disposition', 'filename', 'data'))
 
 
@@ -104,6 +152,17 @@ class MIMEMessage(MIMEPart):
             for a in part.iter_attachments():
                 yield a.as_attachment()
 
+    def strip_attachments(self):
+        """
+        Remove attachment parts, in place.
+        """
+        for part in self.walk():
+            if part.is_multipart():
+                attachments = [id(a) for a in part.iter_attachments()]
+                if attachments:
+                    part.set_payload([p for p in part.get_payload()
+                                      if id(p) not in attachments])
+
     def as_attachment(self):
         content_id = self.content_id or self['x-attachment-id']
         content_type = self.get_content_type()
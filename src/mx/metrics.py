@@ -0,0 +1,94 @@
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    In-process registry of counters, gauges and timers.
+
+    Example:
+    > metrics.incr('imap.fetched')
+    > metrics.gauge('scheduler.interval', 12.5)
+    > with metrics.timer('store.insert'):
+    ...     insert(mail)
+    > metrics.report()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.gauges = {}
+            self.timers = defaultdict(lambda: [0, 0.0, 0.0])  # count, total, max
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers[name]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timers': {name: {'count': count, 'total': total, 'max': max_}
+                           for name, (count, total, max_) in self.timers.items()}
+            }
+
+    def merge(self, snapshot):
+        """
+        Add a snapshot, e.g. of a spawned process, to this registry.
+        """
+        with self._lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] += value
+
+            self.gauges.update(snapshot['gauges'])
+
+            for name, other in snapshot['timers'].items():
+                timer = self.timers[name]
+                timer[0] += other['count']
+                timer[1] += other['total']
+                timer[2] = max(timer[2], other['max'])
+
+    def report(self, level=logging.INFO):
+        snapshot = self.snapshot()
+
+        for name, value in sorted(snapshot['counters'].items()):
+            logger.log(level, 'METRIC: %s = %s', name, value)
+
+        for name, value in sorted(snapshot['gauges'].items()):
+            logger.log(level, 'METRIC: %s = %s', name, value)
+
+        for name, timer in sorted(snapshot['timers'].items()):
+            logger.log(level, 'METRIC: %s = %ix avg %.3fs max %.3fs', name,
+                       timer['count'], timer['total'] / timer['count'], timer['max'])
+
+
+metrics = Metrics()
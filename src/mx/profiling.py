@@ -0,0 +1,278 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from functools import wraps
+from time import monotonic, strftime
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('fetch_unseen', 'message.parse', 'smart_decode', 'insert')
+
+# Allocations are attributed to a stage when its code is on the stack
+STAGE_FILES = {
+    'fetch_unseen': ('*/mx/imap.py', '*/mx/fetch.py', '*/imaplib.py'),
+    'message.parse': ('*/mx/message.py', '*/email/*'),
+    'smart_decode': ('*/mx/encoding.py', '*/chardet/*'),
+    'insert': ('*/mx/stores/*',),
+}
+
+# Profiler currently active in this process, if any
+_active = None
+
+
+@contextmanager
+def stage(name):
+    """
+    Profile a stage of the import while a profiler is active, no-op otherwise.
+    """
+    profiler = _active
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
+
+
+def profiled(name):
+    """
+    Decorator profiling calls as a stage, see stage.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def iterate(name, iterable):
+    """
+    Profile producing each item of an iterable, e.g. fetching batches, as a stage.
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            with stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+
+class Profiler(object):
+    """
+    Profiles import stages with cProfile and tracemalloc while active, and
+    writes a pstats dump, plus text reports of top functions and top
+    allocations, per stage into a directory once stopped.
+
+    Stage time is exclusive, a nested stage (smart_decode while inserting)
+    pauses the outer one. Each thread profiles its stages separately, merged
+    in the reports. A tracemalloc snapshot is taken on leaving a stage with
+    more memory traced than ever before, within it.
+
+    While inactive, stage hooks cost a global lookup.
+
+    Example:
+    > profiler = Profiler('/tmp/mx-profile', cycles=10)
+    > profiler.start()
+    > while not profiler.expired():
+    ...     import_mail()
+    ...     profiler.cycles += 1
+    > profiler.stop()
+    """
+
+    top = 25  # Functions and allocation sites per report
+    frames = 5  # Traceback depth of traced allocations
+    peak_growth = 1.1  # Traced memory growth triggering a new snapshot
+
+    def __init__(self, directory, cycles=None, seconds=None):
+        """
+        :param directory: Directory to write reports in
+        :param cycles: Number of import cycles to profile, if limited
+        :param seconds: Length of profiling window, if limited
+        """
+        self.directory = directory
+        self.max_cycles = cycles
+        self.seconds = seconds
+        self.pid = os.getpid()
+
+        self.cycles = 0
+        self.started_at = None
+        self.deadline = None if seconds is None else monotonic() + seconds
+        self.profiles = {}
+        self.snapshots = {}
+        self.peaks = {}
+        self.local = threading.local()
+        self.tracing = False
+
+    @property
+    def active(self):
+        return _active is self
+
+    def expired(self):
+        if self.max_cycles is not None and self.cycles >= self.max_cycles:
+            return True
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def start(self):
+        global _active
+
+        if self.active:
+            return
+
+        logger.info('Start profiling, reports in %s', self.directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.tracing = True
+
+        self.started_at = monotonic()
+        _active = self
+        metrics.incr('profile.started')
+
+    def stop(self):
+        """
+        Stop profiling and write reports.
+
+        :return: Paths of written reports
+        """
+        global _active
+
+        if not self.active:
+            return []
+
+        _active = None
+
+        try:
+            paths = self.write_reports()
+        finally:
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+
+        logger.info('Stop profiling after %s cycle(s), %.1f seconds: %s report(s) in %s',
+                    self.cycles, monotonic() - self.started_at, len(paths), self.directory)
+        return paths
+
+    @contextmanager
+    def stage(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        if stack:
+            self.disable(stack[-1])
+        stack.append(name)
+        profile = self.enable(name)
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            stack.pop()
+
+            self.sample(name)
+            if stack:
+                self.enable(stack[-1])
+
+    def enable(self, name):
+        key = (name, threading.get_ident())
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active, e.g. in another thread
+            metrics.incr('profile.skipped')
+            return None
+
+        return profile
+
+    def disable(self, name):
+        profile = self.profiles.get((name, threading.get_ident()))
+        if profile is not None:
+            profile.disable()
+
+    def sample(self, name):
+        """
+        Snapshot traced allocations when memory grows beyond the stage's peak.
+        """
+        if not tracemalloc.is_tracing():
+            return
+
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.peaks.get(name, 0) * self.peak_growth:
+            self.peaks[name] = current
+            self.snapshots[name] = tracemalloc.take_snapshot()
+
+    def write_reports(self):
+        prefix = os.path.join(self.directory, '{}-{}'.format(strftime('%Y%m%d-%H%M%S'),
+                                                             os.getpid()))
+        paths = []
+
+        for name in STAGES:
+            profiles = [profile for (stage_name, _), profile in self.profiles.items()
+                        if stage_name == name]
+
+            if profiles:
+                path = '{}-{}.pstats'.format(prefix, name)
+                stats = pstats.Stats(*profiles)
+                stats.dump_stats(path)
+                paths.append(path)
+
+                path = '{}-{}.txt'.format(prefix, name)
+                with open(path, 'w') as f:
+                    stats.stream = f
+                    stats.sort_stats('cumulative').print_stats(self.top)
+                paths.append(path)
+
+            snapshot = self.snapshots.get(name)
+            if snapshot is not None:
+                path = '{}-{}.alloc.txt'.format(prefix, name)
+                with open(path, 'w') as f:
+                    self.write_allocations(f, name, snapshot)
+                paths.append(path)
+
+        return paths
+
+    def write_allocations(self, f, name, snapshot):
+        """
+        Write top allocating tracebacks with stage code on the stack.
+        """
+        patterns = STAGE_FILES[name]
+        matches = {}
+
+        def in_stage(frame):
+            if frame.filename not in matches:
+                matches[frame.filename] = any(fnmatch(frame.filename, pattern)
+                                              for pattern in patterns)
+            return matches[frame.filename]
+
+        # Grouping identical tracebacks first, matching each of them is cheap
+        statistics = [statistic for statistic in snapshot.statistics('traceback')
+                      if any(in_stage(frame) for frame in statistic.traceback)]
+
+        f.write('Top allocations with {} on the stack, at peak of {:.1f} KiB traced\n'.format(
+            name, self.peaks[name] / 1024))
+        for statistic in statistics[:self.top]:
+            f.write('\n{:.1f} KiB in {} blocks\n'.format(statistic.size / 1024, statistic.count))
+            f.write('\n'.join(statistic.traceback.format()))
+            f.write('\n')
@@ -0,0 +1,137 @@
+import json
+import logging
+import re
+from email.parser import BytesHeaderParser
+from email.policy import default as email_policy
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('skip', 'move', 'strip')
+
+# RFC 5322 field name, less characters special to IMAP, e.g. in HEADER.FIELDS (...)
+FIELD_NAME = re.compile(r'[!#$&\'+\-.0-9;<=>?@A-Z^_`a-z|~]+')
+
+
+class RuleError(Exception):
+    pass
+
+
+class Rule(object):
+    """
+    Matches mail on header patterns and size, all given conditions must match.
+
+    Header patterns are case insensitive regular expressions, searched for in
+    the decoded header value. A missing header is matched as empty.
+
+    Actions:
+        skip   Flag mail seen without importing it
+        move   Move mail to folder without importing it
+        strip  Import mail without its attachments
+    """
+
+    def __init__(self, name, action, match=None, folder=None, min_size=None, max_size=None):
+        if action not in ACTIONS:
+            raise RuleError('Rule {}: unknown action {!r}'.format(name, action))
+        if action == 'move' and not folder:
+            raise RuleError('Rule {}: move needs a folder'.format(name))
+        for size in (min_size, max_size):
+            if size is not None and (not isinstance(size, int) or isinstance(size, bool)
+                                     or size < 0):
+                raise RuleError('Rule {}: size {!r} is not a number of bytes'.format(name, size))
+        for header in (match or {}):
+            if not isinstance(header, str) or not FIELD_NAME.fullmatch(header):
+                raise RuleError('Rule {}: invalid header field name {!r}'.format(name, header))
+
+        self.name = name
+        self.action = action
+        self.folder = folder
+        self.min_size = min_size
+        self.max_size = max_size
+
+        try:
+            self.patterns = [(header.lower(), re.compile(pattern, re.IGNORECASE))
+                             for header, pattern in sorted((match or {}).items())]
+        except re.error as e:
+            raise RuleError('Rule {}: {}'.format(name, e))
+
+    def __repr__(self):
+        return '<Rule {} -> {}>'.format(self.name, self.action)
+
+    def matches(self, headers, size):
+        """
+        :param headers: Dict of lower cased header names and decoded values
+        :param size: Mail size in bytes
+        """
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+
+        return all(pattern.search(headers.get(header, ''))
+                   for header, pattern in self.patterns)
+
+
+class Rules(object):
+    """
+    Ordered set of rules, the first matching rule applies.
+
+    Rules are evaluated against mail headers only, fetched together with
+    mail sizes before any mail is downloaded, so skipped and moved mail is
+    never fetched nor parsed.
+
+    Example rules file:
+    > [
+    >   {"name": "auto-replies", "action": "skip",
+    >    "match": {"auto-submitted": "^auto-"}},
+    >   {"name": "lists", "action": "move", "folder": "Lists",
+    >    "match": {"list-id": "."}},
+    >   {"name": "huge", "action": "strip", "min_size": 10485760}
+    > ]
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise RuleError('Rule names must be unique')
+
+        # Only headers some rule looks at are fetched
+        self.headers = sorted(set(header for rule in self.rules
+                                  for header, _ in rule.patterns))
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load rules from a JSON file, a list of Rule keyword arguments.
+        """
+        try:
+            with open(path) as f:
+                return cls(Rule(**rule) for rule in json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            raise RuleError('Failed to load rules from {}: {}'.format(path, e))
+
+    def parse_headers(self, data):
+        """
+        Decode raw header fields into a dict of lower cased names and values.
+        """
+        headers = BytesHeaderParser(policy=email_policy).parsebytes(bytes(data))
+        return dict((name.lower(), str(value)) for name, value in headers.items())
+
+    def match(self, data, size):
+        """
+        Find first rule matching raw header fields and mail size.
+
+        :return: Matching Rule or None
+        """
+        headers = self.parse_headers(data) if self.headers else {}
+
+        for rule in self.rules:
+            if rule.matches(headers, size):
+                metrics.incr('rules.{}.hits'.format(rule.name))
+                return rule
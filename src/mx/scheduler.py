@@ -0,0 +1,129 @@
+import logging
+import random
+from time import monotonic, sleep
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Last poll timestamp per IMAP host, shared by all schedulers in this process
+_last_poll = {}
+
+
+class Scheduler(object):
+    """
+    Adaptive poll scheduler.
+
+    Shortens the interval while mail keeps arriving and backs off exponentially,
+    with jitter, while the mailbox is idle or polling fails. The interval is
+    always kept within min/max bounds and polls against the same host are
+    spaced according to the rate limit.
+
+    Example:
+    > scheduler = Scheduler(host='imap.gmail.com', interval=30)
+    > while True:
+    ...     scheduler.success(import_mail())
+    ...     scheduler.wait()
+    """
+
+    speedup = 2.0  # Interval divisor when mail arrives
+    idle_backoff = 1.5  # Interval multiplier when mailbox is idle
+    failure_backoff = 2.0  # Interval multiplier for consecutive failures
+    wakeup_interval = 1.0  # Seconds between checks for interruption while waiting
+
+    def __init__(self, host, interval, min_interval=None, max_interval=None,
+                 rate_limit=None, jitter=0.1):
+        """
+        :param host: IMAP host, used as rate limit key
+        :param interval: Base interval in seconds
+        :param min_interval: Lower interval bound, defaults to interval
+        :param max_interval: Upper interval bound, defaults to interval
+        :param rate_limit: Max number of polls per minute against host
+        :param jitter: Random spread of each delay, as a fraction of it
+        """
+        self.host = host
+        self.interval = float(interval)
+        self.min_interval = float(min_interval or interval)
+        self.max_interval = float(max_interval or interval)
+        self.rate_limit = float(rate_limit) if rate_limit else None
+        self.jitter = jitter
+
+        self.current = self.clamp(self.interval)
+        self.failures = 0
+
+    def clamp(self, interval):
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def success(self, count):
+        """
+        Register a successful poll that found <count> new mails.
+        """
+        self.failures = 0
+
+        if count:
+            self.current = self.clamp(min(self.current, self.interval) / self.speedup)
+            metrics.incr('scheduler.speedup')
+        else:
+            self.current = self.clamp(self.current * self.idle_backoff)
+            metrics.incr('scheduler.idle')
+
+    def reset(self):
+        """
+        Return to base interval, e.g. once a subscription is established.
+        """
+        self.failures = 0
+        self.current = self.clamp(self.interval)
+
+    def failure(self):
+        """
+        Register a failed poll, first failure waits the base interval.
+        """
+        self.failures += 1
+        backoff = self.failure_backoff ** (self.failures - 1)
+        self.current = self.clamp(max(self.current, self.interval * backoff))
+        metrics.incr('scheduler.failure')
+
+    def next_delay(self, now=None):
+        """
+        Seconds to wait before next poll, jittered and rate limited.
+        """
+        spread = self.current * self.jitter
+        delay = self.clamp(self.current + random.uniform(-spread, spread))
+
+        if self.rate_limit:
+            now = monotonic() if now is None else now
+            last_poll = _last_poll.get(self.host)
+            if last_poll is not None:
+                earliest = last_poll + 60.0 / self.rate_limit
+                delay = max(delay, earliest - now)
+
+        return delay
+
+    def wait(self, interrupted=None):
+        """
+        Sleep until next poll.
+
+        :param interrupted: Callable, checked every second, stops sleeping
+                            once it returns true
+        """
+        delay = self.next_delay()
+        metrics.gauge('scheduler.interval', round(delay, 3))
+        logger.debug('Sleep for %.1f seconds (interval: %.1f, failures: %s)...',
+                     delay, self.current, self.failures)
+
+        if interrupted is None:
+            sleep(delay)
+            return
+
+        deadline = monotonic() + delay
+        while not interrupted():
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            sleep(min(remaining, self.wakeup_interval))
+
+    def poll(self):
+        """
+        Register the start of a poll against host.
+        """
+        _last_poll[self.host] = monotonic()
@@ -0,0 +1,103 @@
+import logging
+from math import isnan
+from multiprocessing import Lock, RawValue
+from time import monotonic
+
+from ..metrics import metrics
+from .errors import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+NaN = float('nan')
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker guarding calls to a slow or failing backend.
+
+    Opens after <failure_threshold> consecutive failures, rejecting calls
+    instantly with CircuitOpenError. After <reset_timeout> seconds it turns
+    half-open and lets calls through again; the first failure re-opens it,
+    the first success closes it.
+
+    State is kept in shared memory. Processes forked from the one creating
+    the breaker, e.g. spawned imports, share it with it and each other, so
+    failures in one of them open it for all.
+
+    Example:
+    > breaker = CircuitBreaker('tinbox')
+    > breaker.call(tinbox.create_ticket, ...)
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = Lock()
+        self._failures = RawValue('i', 0)
+        self._opened_at = RawValue('d', NaN)
+
+    @property
+    def failures(self):
+        return self._failures.value
+
+    @failures.setter
+    def failures(self, failures):
+        self._failures.value = failures
+
+    @property
+    def opened_at(self):
+        opened_at = self._opened_at.value
+        return None if isnan(opened_at) else opened_at
+
+    @opened_at.setter
+    def opened_at(self, opened_at):
+        self._opened_at.value = NaN if opened_at is None else opened_at
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        return self.state != self.OPEN
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Circuit [%s] closed', self.name)
+                metrics.incr('breaker.{}.closed'.format(self.name))
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                logger.warning('Circuit [%s] open after %s failure(s), pause for %s seconds',
+                               self.name, self.failures, self.reset_timeout)
+                metrics.incr('breaker.{}.opened'.format(self.name))
+                self.opened_at = monotonic()
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            metrics.incr('breaker.{}.rejected'.format(self.name))
+            raise CircuitOpenError('Circuit [{}] is open'.format(self.name))
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+
+        self.success()
+        return result
@@ -1 +1,7 @@
-class BackendError(Exception): pass
\ No newline at end of file
+class BackendError(Exception): pass
+
+
+class CircuitOpenError(BackendError): pass
+
+
+class ContentError(Exception): pass
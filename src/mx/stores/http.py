@@ -0,0 +1,102 @@
+import logging
+import os
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PoolAdapter(HTTPAdapter):
+    """
+    Keep-alive connection pool with a default timeout, counting requests
+    and connections opened, to tell how well connections are reused.
+
+    Retries connection errors, and failed or 502-504 responses to
+    idempotent requests, e.g. PUT but not POST.
+    """
+
+    def __init__(self, name, pool_size=4, timeout=30, retries=2, backoff=0.5):
+        self.name = name
+        self.timeout = timeout
+        max_retries = Retry(total=retries, backoff_factor=backoff,
+                            status_forcelist=(502, 503, 504))
+
+        super(PoolAdapter, self).__init__(pool_connections=1, pool_maxsize=pool_size,
+                                          max_retries=max_retries)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        try:
+            with metrics.timer('http.{}.request'.format(self.name)):
+                return super(PoolAdapter, self).send(request, **kwargs)
+        finally:
+            metrics.incr('http.{}.requests'.format(self.name))
+            metrics.gauge('http.{}.connections'.format(self.name), self.connections())
+
+    def connections(self):
+        """
+        Number of connections opened by this adapter's pools.
+        """
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+class SessionPool(object):
+    """
+    Mounts a per process connection pool on a requests session.
+
+    A forked child gets a fresh pool mounted on first use, so connections of
+    the parent process are never shared across processes, while the rest of
+    the session state, e.g. an OAuth token, is inherited.
+
+    Example:
+    > pool = SessionPool('tinbox', pool_size=4)
+    > pool.mount(tinbox.session)
+    > tinbox.create_ticket(...)
+    """
+
+    def __init__(self, name, **settings):
+        """
+        :param name: Metrics name
+        :param settings: PoolAdapter settings; pool_size, timeout, retries, backoff
+        """
+        self.name = name
+        self.settings = settings
+        self.pid = None
+        self.adapter = None
+        self.stale = False
+
+    def configure(self, **settings):
+        """
+        Update settings, a new pool is mounted on next use if they changed.
+        """
+        settings = dict(self.settings, **settings)
+        if settings != self.settings:
+            self.settings = settings
+            self.stale = True
+
+    def mount(self, session):
+        pid = os.getpid()
+
+        if self.pid != pid or self.stale:
+            if self.pid == pid:
+                # Settings changed, close our pool's keep-alive connections
+                logger.debug('Settings changed, mount new %s connection pool', self.name)
+                self.adapter.close()
+            elif self.pid is not None:
+                # Inherited pool holds the parent's sockets, leave them be
+                logger.debug('Forked, mount new %s connection pool', self.name)
+                metrics.incr('http.{}.forks'.format(self.name))
+
+            self.adapter = PoolAdapter(self.name, **self.settings)
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self.pid = pid
+            self.stale = False
+
+        return session
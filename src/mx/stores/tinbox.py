@@ -3,31 +3,81 @@ import logging
 
 from tinbox_client import Tinbox
 
-from .errors import BackendError
+from .breaker import CircuitBreaker
+from .errors import BackendError, ContentError
+from .http import SessionPool
 
 _log = logging.getLogger(__name__)
 
 tinbox = Tinbox()
 
+breaker = CircuitBreaker('tinbox')
+
+pool = SessionPool('tinbox')
+
+
+def configure(**settings):
+    """
+    Configure and mount the tinbox connection pool, see http.PoolAdapter for
+    settings. Processes forked from here on inherit the session, and its
+    OAuth token, mounting a pool of their own on first use.
+    """
+    pool.configure(**settings)
+    pool.mount(tinbox.session)
+
 
 def insert(mail):
+    """
+    Create a tinbox ticket from mail. Only calls to tinbox are guarded by
+    the tinbox circuit breaker, mail that can't be read doesn't count as a
+    backend failure.
+
+    :raise ContentError: Ticket could not be made from mail
+    :raise CircuitOpenError: Backend is considered down, mail was not sent
+    :raise BackendError: Backend failed to create ticket
+    """
     try:
-        envelope = mail.get_envelope()
-        email, name = envelope['from']
+        ticket = _ticket(mail)
+    except Exception as e:
+        _log.exception('Could not read mail for tinbox.')
+        raise ContentError(e)
+
+    breaker.call(_insert, ticket)
 
-        body_content = mail.get_body_content()
 
-        attachments = list(mail.get_attachments())
+def _ticket(mail):
+    envelope = mail.get_envelope()
+    email, name = envelope['from']
 
-        uuids = []
+    body_content = mail.get_body_content()
 
-        for match in re.finditer(r'[a-f0-9]{8}-([a-f0-9]{4}-){3}[a-f0-9]{12}',
-                                 body_content):
-            uuids.append(match.group(0))
+    attachments = list(mail.get_attachments())
+
+    uuids = []
+
+    for match in re.finditer(r'[a-f0-9]{8}-([a-f0-9]{4}-){3}[a-f0-9]{12}',
+                             body_content):
+        uuids.append(match.group(0))
+
+    return {
+        'email': email,
+        'name': name,
+        'subject': mail.subject,
+        'body': body_content,
+        'context': uuids or None,
+        'attachments': attachments
+    }
+
+
+def _insert(ticket):
+    pool.mount(tinbox.session)
+
+    try:
+        attachments = ticket['attachments']
 
         resp = tinbox.create_ticket(
-            email, mail.subject, mail.get_body_content(),
-            sender_name=name, context=uuids or None,
+            ticket['email'], ticket['subject'], ticket['body'],
+            sender_name=ticket['name'], context=ticket['context'],
             attachments=[a.filename for a in attachments])
 
         for attachment_pk, attachment in zip(resp['attachments'], attachments):
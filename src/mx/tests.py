@@ -1,8 +1,34 @@
+import io
+import json
+import os
+import queue
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import types
+import zlib
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import SimpleQueue
 from pprint import pprint
+from time import monotonic, sleep
 from unittest import TestCase
 
-from . import message, imap
+import requests
+
+from . import message, imap, profiling, scheduler
+from .cli import command
+from .cli.processing import spawnable
+from .encoding import smart_decode
+from .fetch import FetchReader
+from .importer import Importer, Prefetcher, split_shards
+from .metrics import metrics
+from .rules import Rule, RuleError, Rules
+from .stores.breaker import CircuitBreaker
+from .stores.http import SessionPool
+from .stores.errors import BackendError, CircuitOpenError, ContentError
 
 
 EMAILS = (
@@ -37,3 +63,757 @@ class MTATest(TestCase):
         sys.argv = 'cli import -u foo@example.com -p bar'.split()
         from mx.cli.command import Interface
         Interface()
+
+
+class SchedulerTest(TestCase):
+
+    def setUp(self):
+        scheduler._last_poll.clear()
+        self.scheduler = scheduler.Scheduler(host='imap.example.com', interval=30,
+                                             min_interval=5, max_interval=300,
+                                             rate_limit=6, jitter=0)
+
+    def test_speedup(self):
+        self.scheduler.success(3)
+        self.assertEqual(self.scheduler.current, 15)
+        self.scheduler.success(1)
+        self.scheduler.success(1)
+        self.scheduler.success(1)
+        self.assertEqual(self.scheduler.current, 5)
+
+    def test_idle_backoff(self):
+        for _ in range(10):
+            self.scheduler.success(0)
+        self.assertEqual(self.scheduler.current, 300)
+
+    def test_failure_backoff(self):
+        self.scheduler.success(5)
+        self.scheduler.failure()
+        self.assertEqual(self.scheduler.current, 30)
+        self.scheduler.failure()
+        self.assertEqual(self.scheduler.current, 60)
+        self.scheduler.success(0)
+        self.assertEqual(self.scheduler.failures, 0)
+
+    def test_reset(self):
+        self.scheduler.failure()
+        self.scheduler.failure()
+        self.scheduler.failure()
+        self.scheduler.reset()
+        self.assertEqual(self.scheduler.failures, 0)
+        self.scheduler.failure()
+        self.assertEqual(self.scheduler.current, 30)
+
+    def test_rate_limit(self):
+        self.scheduler.success(10)
+        self.scheduler.success(10)
+        scheduler._last_poll['imap.example.com'] = 100.0
+        self.assertEqual(self.scheduler.next_delay(now=101.0), 9.0)
+        self.assertEqual(self.scheduler.next_delay(now=200.0), 7.5)
+
+    def test_interrupted_wait(self):
+        checks = []
+        self.scheduler.wakeup_interval = 0.01
+        self.scheduler.wait(interrupted=lambda: checks.append(1) or len(checks) > 2)
+        self.assertEqual(len(checks), 3)
+
+
+class BackpressureTest(TestCase):
+
+    class Client(object):
+
+        def __init__(self, batches):
+            self.batches = batches
+            self.fetched = 0
+            self.acknowledged = []
+            self.threads = set()
+
+        def fetch_unseen(self, parser, **kwargs):
+            for batch in self.batches:
+                self.fetched += 1
+                yield [(index, uid, self.feed(parser(), msg)) for index, uid, msg in batch]
+
+        def feed(self, parser, msg):
+            parser.feed(msg)
+            return parser
+
+        def acknowledge(self, uids):
+            self.acknowledged.append(imap.uid_set(uids))
+            self.threads.add(threading.current_thread())
+
+        @contextmanager
+        def mailbox(self, name):
+            yield
+
+        def search_unseen(self):
+            return []
+
+        def fetch_batches(self, uids, parser, **kwargs):
+            return self.fetch_unseen(parser)
+
+    def test_split_batches(self):
+        sizes = [('1', 10), ('2', 10), ('3', 10), ('4', 100), ('5', 10)]
+        batches = list(imap.split_batches(sizes, batch_size=2, batch_bytes=50))
+        self.assertEqual(batches, [['1', '2'], ['3'], ['4'], ['5']])
+
+    def test_breaker(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+
+        def fail():
+            raise BackendError()
+
+        for _ in range(2):
+            with self.assertRaises(BackendError):
+                breaker.call(fail)
+
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(lambda: None)
+
+        breaker.opened_at -= 60
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.call(lambda: None)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_shared_breaker(self):
+        breaker = CircuitBreaker('test', failure_threshold=2)
+        breaker.failure()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                breaker.failure()
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        self.assertEqual(breaker.failures, 2)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_pause_fetching(self):
+        breaker = CircuitBreaker('test', failure_threshold=2)
+
+        def insert(mail):
+            breaker.call(self.fail_insert)
+
+        batch = [(str(n), str(n), EMAILS[0]) for n in range(1, 4)]
+        client = self.Client([batch, batch])
+
+        with self.assertRaises(CircuitOpenError):
+            Importer(client, insert, breaker).run()
+
+        self.assertEqual(client.fetched, 1)
+        self.assertEqual(client.acknowledged, [])
+
+    def test_acknowledge_batch(self):
+        batch = [(str(n), str(uid), EMAILS[0]) for n, uid in enumerate((1, 2, 3, 5, 7, 8), start=1)]
+        batch.insert(2, ('7', '4', 'not bytes'))  # Fails to parse, acknowledged anyway
+        client = self.Client([batch])
+
+        def insert(mail):
+            if insert.calls == 3:
+                insert.calls += 1
+                raise BackendError()
+            insert.calls += 1
+        insert.calls = 0
+
+        Importer(client, insert, CircuitBreaker('test')).run()
+        self.assertEqual(client.acknowledged, ['1:4,7:8'])
+
+    def test_reject_content(self):
+        batch = [(str(uid), str(uid), EMAILS[0]) for uid in range(1, 9)]
+        client = self.Client([batch])
+        inserted = []
+
+        def insert(mail):
+            if len(insert.calls) < 5:
+                insert.calls.append(mail)
+                raise ContentError('No sender')
+            inserted.append(mail)
+        insert.calls = []
+
+        Importer(client, insert, CircuitBreaker('test', failure_threshold=2)).run()
+        self.assertEqual(len(inserted), 3)
+        self.assertEqual(client.acknowledged, ['1:8'])
+
+    def test_prefetch(self):
+        batches = [[(str(uid), str(uid), EMAILS[0]) for uid in range(n, n + 3)] for n in (1, 4, 7)]
+        client = self.Client(batches)
+        inserted = []
+
+        count = Importer(client, inserted.append, CircuitBreaker('test'), prefetch=1).run()
+
+        self.assertEqual(count, 9)
+        self.assertEqual(len(inserted), 9)
+        self.assertEqual(client.acknowledged, ['1:3', '4:6', '7:9'])
+        self.assertNotIn(threading.current_thread(), client.threads)
+
+    def test_spool_error(self):
+        batch = [(str(uid), str(uid), EMAILS[0]) for uid in range(1, 4)]
+        client = self.Client([batch])
+        inserted = []
+
+        spool = os.path.join(tempfile.gettempdir(), 'mx-missing-spool', 'mail')
+        Importer(client, inserted.append, CircuitBreaker('test'), spool=spool).run()
+
+        self.assertEqual(len(inserted), 3)
+        self.assertEqual(client.acknowledged, ['1:3'])
+
+    def test_uid_set(self):
+        self.assertEqual(imap.uid_set([]), '')
+        self.assertEqual(imap.uid_set(['3', 1, 2, 2, 45, 42] + list(range(5, 41))), '1:3,5:40,42,45')
+
+    def test_split_shards(self):
+        self.assertEqual(split_shards([7, 1, 3, 2, 9, 5, 8], 3), [[1, 2, 3], [5, 7], [8, 9]])
+        self.assertEqual(split_shards([1], 2), [[1], []])
+
+    def fail_insert(self):
+        raise BackendError()
+
+
+class ShardTest(TestCase):
+
+    class Client(object):
+
+        def __init__(self, uids=(), fail_after=None):
+            self.uids = list(uids)
+            self.fail_after = fail_after  # Number of batches before connection dies
+            self.acknowledged = []
+
+        @contextmanager
+        def mailbox(self, name, readonly=False):
+            yield
+
+        def search_unseen(self):
+            return self.uids
+
+        def fetch_batches(self, uids, parser, batch_size, **kwargs):
+            for n in range(0, len(uids), batch_size):
+                if self.fail_after is not None and n >= self.fail_after * batch_size:
+                    break
+                yield [(str(uid), str(uid), self.feed(parser(), EMAILS[0]))
+                       for uid in uids[n:n + batch_size]]
+
+            if self.fail_after is not None:
+                raise imap.IMAP.abort('socket error: EOF')
+
+        def feed(self, parser, msg):
+            parser.feed(msg)
+            return parser
+
+        def acknowledge(self, uids):
+            if self.fail_after is not None:
+                raise imap.IMAP.abort('socket error: EOF')
+            self.acknowledged.append(imap.uid_set(uids))
+
+        def move(self, uids, mailbox):
+            if self.fail_after is not None:
+                raise imap.IMAP.abort('socket error: EOF')
+
+    class Connection(object):
+
+        def __init__(self, client):
+            self.client = client
+            self.closed = False
+
+        def __enter__(self):
+            return self.client
+
+        def __exit__(self, *exc_info):
+            self.closed = True
+            raise imap.IMAP.abort('socket error: EOF')
+
+    def run_fetchers(self, importer, clients):
+        batches = queue.Queue(maxsize=len(clients))
+        prefetchers = [Prefetcher(client, partial(importer.fetch_batches, uids=client.uids), batches)
+                       for client in clients]
+        return importer.run_fetchers(prefetchers, batches)
+
+    def test_failed_shard(self):
+        healthy = self.Client([1, 2, 3, 4])
+        failed = self.Client([5, 6, 7, 8], fail_after=0)
+        importer = Importer(healthy, lambda mail: None, CircuitBreaker('test'), batch_size=2)
+
+        self.assertEqual(self.run_fetchers(importer, [healthy, failed]), 4)
+        self.assertEqual(healthy.acknowledged, ['1:2', '3:4'])
+
+    def test_recover_checkpoint(self):
+        healthy = self.Client(range(1, 7))
+        failed = self.Client(fail_after=1)
+        connection = self.Connection(failed)
+        inserted = []
+
+        importer = Importer(healthy, inserted.append, CircuitBreaker('test'), batch_size=3,
+                            connections=2, connect=lambda: connection)
+
+        self.assertEqual(importer.run(), 6)
+        self.assertEqual(len(inserted), 6)
+        self.assertEqual(sorted(healthy.acknowledged), ['1:3', '4:6'])
+        self.assertEqual(failed.acknowledged, [])
+        self.assertTrue(connection.closed)
+
+    def test_failed_commands(self):
+        client = self.Client([1, 2, 3, 4], fail_after=1)
+        fetch_batches = client.fetch_batches
+
+        def slow_fetch_batches(*args, **kwargs):
+            for batch in fetch_batches(*args, **kwargs):
+                yield batch
+                sleep(0.2)  # Acknowledge and move are submitted meanwhile
+
+        client.fetch_batches = slow_fetch_batches
+        importer = Importer(client, lambda mail: None, CircuitBreaker('test'), batch_size=2,
+                            archive='Done', prefetch=2)
+        importer.wait_interval = 0.1
+        errors = []
+
+        def run():
+            try:
+                importer.run()
+            except imap.IMAP.abort as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+    def test_all_failed(self):
+        clients = [self.Client([1, 2], fail_after=0), self.Client([3, 4], fail_after=0)]
+        importer = Importer(clients[0], lambda mail: None, CircuitBreaker('test'))
+
+        with self.assertRaises(imap.IMAP.abort):
+            self.run_fetchers(importer, clients)
+
+
+class AcknowledgeTest(TestCase):
+
+    class Client(imap.IMAP):
+
+        def __init__(self, capabilities=(), store='OK'):
+            self.capabilities = capabilities
+            self.store = store
+            self.commands = []
+
+        def uid(self, command, *args):
+            self.commands.append(command)
+            return (self.store if command == 'STORE' else 'OK'), [b'done']
+
+        def expunge(self):
+            self.commands.append('EXPUNGE')
+
+    def test_acknowledge(self):
+        client = self.Client()
+        client.acknowledge([1, 2])
+        self.assertEqual(client.commands, ['STORE'])
+
+        client = self.Client(store='NO')
+        self.assertRaises(imap.IMAP.error, client.acknowledge, [1, 2])
+
+    def test_move(self):
+        client = self.Client(capabilities=('UIDPLUS',))
+        client.move('1:2', 'Archive')
+        self.assertEqual(client.commands, ['COPY', 'STORE', 'EXPUNGE'])
+
+        client = self.Client()
+        client.move('1:2', 'Archive')
+        self.assertEqual(client.commands, ['COPY', 'STORE'])
+
+        client = self.Client(store='NO')
+        self.assertRaises(imap.IMAP.error, client.move, '1:2', 'Archive')
+
+
+class InterfaceTest(TestCase):
+
+    class Interface(command.Interface):
+
+        def __init__(self):
+            self.opts = {'--metrics-interval': 300}
+            self.pid = os.getpid()
+            self.reports = SimpleQueue()
+            self._reported_at = monotonic()
+            self._running = True
+            self.store = types.SimpleNamespace(breaker=CircuitBreaker('test', failure_threshold=1))
+            self.imports = 0
+
+        @spawnable(debug=True)
+        def import_mail(self):
+            self.imports += 1
+            self.running = True
+            return types.SimpleNamespace(is_alive=lambda: self.running)
+
+        def configure_store(self):
+            pass
+
+        def setup_logging(self):
+            pass
+
+    class Subscriber(object):
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.config = os.path.join(directory, 'mx.json')
+        self.configure()
+
+        self.addCleanup(setattr, sys, 'argv', sys.argv)
+        sys.argv = ['mx', 'import', '-u', 'user', '-p', 'secret', '--interval', '10',
+                    '--config', self.config]
+
+    def configure(self, **options):
+        with open(self.config, 'w') as f:
+            json.dump(options, f)
+
+    def test_load_options(self):
+        self.configure(**{'batch-size': 5, '--archive': 'Done', '-v': 1})
+        opts = self.Interface().load_options()
+
+        self.assertEqual(opts['--interval'], '10')
+        self.assertEqual(opts['--batch-size'], 5)
+        self.assertEqual(opts['--archive'], 'Done')
+        self.assertEqual(opts['--username'], 'user')
+        self.assertEqual(opts['-v'], 1)
+
+    def test_invalid_options(self):
+        interface = self.Interface()
+
+        for options in ({'foo': 1}, {'config': 'other.json'}, {'batch-size': 'x'},
+                        {'interval': None}, {'store-timeout': []}):
+            self.configure(**options)
+            self.assertRaises(ValueError, interface.load_options)
+
+    def test_reload(self):
+        interface = self.Interface()
+        interface.opts = interface.load_options()
+        scheduler = interface.scheduler = interface.create_scheduler()
+        subscriber = interface.subscriber = self.Subscriber()
+
+        interface.reload()
+        self.assertIs(interface.scheduler, scheduler)
+        self.assertIs(interface.subscriber, subscriber)
+
+        self.configure(interval=60, archive='Done')
+        interface.reload()
+        self.assertEqual(interface.opts['--archive'], 'Done')
+        self.assertIsNot(interface.scheduler, scheduler)
+        self.assertEqual(interface.scheduler.interval, 60)
+        self.assertIs(interface.subscriber, subscriber)
+
+        self.configure(interval=60, archive='Done', host='imap.example.com')
+        interface.reload()
+        self.assertIsNone(interface.subscriber)
+        self.assertTrue(subscriber.closed)
+
+    def test_reload_failure(self):
+        interface = self.Interface()
+        opts = interface.opts = interface.load_options()
+        scheduler = interface.scheduler = interface.create_scheduler()
+        subscriber = interface.subscriber = self.Subscriber()
+
+        for config in ('{"batch-size": "x", "interval": 60}', '{"foo": 1}', '{bad'):
+            with open(self.config, 'w') as f:
+                f.write(config)
+
+            interface.reload()
+            self.assertIs(interface.opts, opts)
+            self.assertIs(interface.scheduler, scheduler)
+            self.assertIs(interface.subscriber, subscriber)
+
+    def test_defer_import(self):
+        interface = self.Interface()
+        breaker = interface.store.breaker
+
+        breaker.failure()
+        interface.spawn_import()
+        self.assertEqual(interface.imports, 0)
+        self.assertFalse(interface.interrupted())
+
+        breaker.opened_at -= breaker.reset_timeout
+        self.assertTrue(interface.interrupted())
+
+        interface.spawn_import()
+        self.assertEqual(interface.imports, 1)
+        self.assertFalse(interface.interrupted())
+
+    def test_coalesce_imports(self):
+        interface = self.Interface()
+
+        interface.spawn_import()
+        interface.spawn_import()
+        interface.spawn_import()
+        self.assertEqual(interface.imports, 1)
+        self.assertFalse(interface.interrupted())
+
+        interface.running = False
+        self.assertTrue(interface.interrupted())
+
+        interface.spawn_import()
+        self.assertEqual(interface.imports, 2)
+        self.assertFalse(interface.interrupted())
+
+    def test_connections(self):
+        interface = self.Interface()
+        self.configure(connections=20)
+        interface.opts = interface.load_options()
+        self.assertEqual(interface.connections, 15)
+
+        self.configure(connections=20, subscribe=True)
+        interface.opts = interface.load_options()
+        self.assertEqual(interface.connections, 14)
+
+        interface.spawn_import()
+        interface.spawn_import()
+        self.assertEqual(interface.imports, 1)
+
+    def test_report_metrics(self):
+        interface = self.Interface()
+        metrics.reset()
+        metrics.incr('rules.auto.hits')
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with interface.reporting():
+                    metrics.incr('rules.auto.hits', 2)
+                    metrics.observe('imap.login', 0.5)
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        interface.report_metrics(force=True)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['rules.auto.hits'], 3)
+        self.assertEqual(snapshot['timers']['imap.login'], {'count': 1, 'total': 0.5, 'max': 0.5})
+
+
+class SessionPoolTest(TestCase):
+
+    def test_mount(self):
+        session = requests.Session()
+        pool = SessionPool('test', pool_size=2, timeout=5)
+
+        pool.mount(session)
+        adapter = session.get_adapter('https://tinbox')
+        self.assertIs(adapter, pool.adapter)
+        self.assertEqual(adapter.timeout, 5)
+
+        pool.configure(timeout=5)
+        pool.mount(session)
+        self.assertIs(session.get_adapter('https://tinbox'), adapter)
+
+        pool.pid = -1  # As if forked
+        pool.mount(session)
+        self.assertIsNot(session.get_adapter('https://tinbox'), adapter)
+
+        adapter = session.get_adapter('https://tinbox')
+        adapter.poolmanager.connection_from_url('https://tinbox')
+        pool.configure(timeout=10)
+        pool.mount(session)
+        self.assertEqual(session.get_adapter('http://tinbox').timeout, 10)
+        self.assertEqual(len(adapter.poolmanager.pools), 0)  # Closed
+
+    def test_fork(self):
+        session = requests.Session()
+        pool = SessionPool('test')
+        pool.mount(session)
+        adapter = session.get_adapter('https://tinbox')
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                pool.mount(session)
+                remounted = session.get_adapter('https://tinbox') is not adapter
+                os._exit(0 if remounted and pool.pid == os.getpid() else 1)
+            finally:
+                os._exit(2)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        pool.mount(session)
+        self.assertIs(session.get_adapter('https://tinbox'), adapter)
+
+
+class DeflateTest(TestCase):
+
+    def test_deflate_file(self):
+        local, remote = socket.socketpair()
+        self.addCleanup(remote.close)
+
+        deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = b'* 1 FETCH (BODY[] {12}\r\nHello World!)\r\nA001 OK done\r\n'
+        remote.sendall(deflater.compress(data) + deflater.flush(zlib.Z_SYNC_FLUSH))
+
+        file = imap.DeflateFile(local, local.makefile('rb'))
+        self.assertEqual(file.readline(), b'* 1 FETCH (BODY[] {12}\r\n')
+        self.assertTrue(file.pending())
+        self.assertEqual(file.read(12), b'Hello World!')
+        self.assertEqual(file.readline(), b')\r\n')
+        self.assertEqual(file.readline(5), b'A001 ')
+        self.assertEqual(file.readline(), b'OK done\r\n')
+        self.assertFalse(file.pending())
+
+        file.close()
+        local.close()
+
+
+class StreamTest(TestCase):
+
+    def test_stream_parser(self):
+        parser = message.StreamParser(keep_raw=True)
+        for n in range(0, len(EMAILS[0]), 100):
+            parser.feed(EMAILS[0][n:n + 100])
+
+        mail = parser.close()
+        self.assertEqual(parser.raw, EMAILS[0])
+        self.assertEqual(mail.subject, message.parse(EMAILS[0]).subject)
+        self.assertEqual(len(list(mail.get_attachments())), 2)
+
+
+class FetchReaderTest(TestCase):
+
+    class Connection(object):
+        abort = error = imap.IMAP.error
+
+        def __init__(self, data):
+            self.stream = io.BytesIO(data)
+            self.tagged_commands = {}
+            self.untagged_responses = []
+
+        def _command(self, *args):
+            self.tagged_commands[b'A001'] = None
+            return b'A001'
+
+        def readline(self):
+            return self.stream.readline()
+
+        def readinto(self, buffer):
+            self.stream.readinto(buffer)
+
+        def _append_untagged(self, typ, data):
+            self.untagged_responses.append((typ, data))
+
+        def _check_bye(self):
+            pass
+
+    def test_attributes(self):
+        header = b'Subject: Hi\r\n\r\n'
+        connection = self.Connection(
+            b'* 3 EXISTS\r\n'
+            b'* 1 FETCH (FLAGS (\\Seen $Label) RFC822.SIZE 42 UID 7 INTERNALDATE "17-Jul-1996 02:44:25 -0700" '
+            b'BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "US-ASCII") NIL NIL "7BIT" 3 1 NIL NIL NIL) '
+            b'BODY[HEADER.FIELDS (SUBJECT)] {15}\r\n' + header + b' ENVELOPE (NIL "a \\"b\\"" NIL))\r\n'
+            b'A001 OK done\r\n')
+
+        (index, attributes), = FetchReader(connection).fetch('7', '(...)')
+
+        self.assertEqual(index, 1)
+        self.assertEqual(attributes['UID'], 7)
+        self.assertEqual(attributes['FLAGS'], [b'\\Seen', b'$Label'])
+        self.assertEqual(attributes['RFC822.SIZE'], 42)
+        self.assertEqual(attributes['INTERNALDATE'], b'17-Jul-1996 02:44:25 -0700')
+        self.assertEqual(attributes['BODYSTRUCTURE'][:3], [b'TEXT', b'PLAIN', [b'CHARSET', b'US-ASCII']])
+        self.assertEqual(attributes['BODYSTRUCTURE'][3], None)
+        self.assertEqual(attributes['BODY[HEADER.FIELDS (SUBJECT)]'], header)
+        self.assertEqual(attributes['ENVELOPE'], [None, b'a "b"', None])
+        self.assertEqual(connection.untagged_responses, [('EXISTS', b'3')])
+        self.assertEqual(connection.tagged_commands, {})
+
+    def test_stream_body(self):
+        connection = self.Connection(b''.join(
+            b'* %d FETCH (BODY[] {%d}\r\n%s UID %d)\r\n' % (n, len(mail), mail, n * 10)
+            for n, mail in enumerate(EMAILS, start=1)) + b'A001 OK done\r\n')
+
+        reader = FetchReader(connection)
+        reader.chunk_size = 1000
+        responses = list(reader.fetch('10:30', '(UID BODY.PEEK[])', sink=message.StreamParser))
+
+        self.assertEqual([attributes['UID'] for _, attributes in responses], [10, 20, 30])
+        for (_, attributes), mail in zip(responses, EMAILS):
+            self.assertEqual(attributes['BODY[]'].size, len(mail))
+            self.assertEqual(attributes['BODY[]'].close().subject, message.parse(mail).subject)
+
+
+class RulesTest(TestCase):
+
+    def test_match(self):
+        metrics.reset()
+        rules = Rules([
+            Rule('auto', 'skip', {'Auto-Submitted': '^auto-'}),
+            Rule('lists', 'move', {'list-id': 'example', 'subject': 'digest'}, folder='Lists'),
+            Rule('huge', 'strip', min_size=1000),
+        ])
+        self.assertEqual(rules.headers, ['auto-submitted', 'list-id', 'subject'])
+
+        headers = b'Auto-Submitted: Auto-Replied\r\n\r\n'
+        self.assertEqual(rules.match(headers, 10).name, 'auto')
+
+        headers = b'List-Id: <dev.example.org>\r\nSubject: =?UTF-8?Q?Daily_digest?=\r\n\r\n'
+        self.assertEqual(rules.match(headers, 10).name, 'lists')
+        self.assertEqual(rules.match(headers[:30] + b'\r\n', 10), None)
+        self.assertEqual(rules.match(b'', 1000).name, 'huge')
+
+        self.assertEqual(dict((name, value) for name, value in metrics.snapshot()['counters'].items()
+                              if name.startswith('rules.')),
+                         {'rules.auto.hits': 1, 'rules.lists.hits': 1, 'rules.huge.hits': 1})
+
+    def test_invalid(self):
+        self.assertRaises(RuleError, Rule, 'foo', 'delete')
+        self.assertRaises(RuleError, Rule, 'foo', 'move')
+        self.assertRaises(RuleError, Rule, 'foo', 'skip', {'from': '('})
+        self.assertRaises(RuleError, Rule, 'foo', 'skip', {'list id': '.'})
+        self.assertRaises(RuleError, Rule, 'foo', 'skip', {'from)': '.'})
+        self.assertRaises(RuleError, Rule, 'foo', 'skip', {'x]': '.'})
+        self.assertRaises(RuleError, Rule, 'foo', 'skip', {'': '.'})
+        self.assertRaises(RuleError, Rule, 'foo', 'skip', {'from\n': '.'})
+        self.assertRaises(RuleError, Rule, 'foo', 'strip', min_size='10MB')
+        self.assertRaises(RuleError, Rule, 'foo', 'strip', max_size=-1)
+        self.assertEqual(Rule('foo', 'skip', {'X-Spam_Flag.1': '.'}, max_size=10).max_size, 10)
+        self.assertRaises(RuleError, Rules, [Rule('foo', 'skip'), Rule('foo', 'strip')])
+
+    def test_strip_attachments(self):
+        mail = message.parse(EMAILS[0])
+        self.assertEqual(len(list(mail.get_attachments())), 2)
+
+        mail.strip_attachments()
+        self.assertEqual(list(mail.get_attachments()), [])
+        self.assertIn('Jag skriver lite', mail.get_body_content())
+
+
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stages(self):
+        profiler = profiling.Profiler(self.directory, cycles=1)
+        profiler.start()
+        try:
+            with profiling.stage('insert'):
+                self.assertEqual(smart_decode(b'caf\xc3\xa9', 'utf-8'), 'caf\xe9')
+            profiler.cycles += 1
+        finally:
+            paths = profiler.stop()
+
+        self.assertTrue(profiler.expired())
+        self.assertFalse(profiler.active)
+        self.assertEqual(sorted(os.path.basename(path).split('-', 3)[3] for path in paths), [
+            'insert.alloc.txt', 'insert.pstats', 'insert.txt',
+            'smart_decode.alloc.txt', 'smart_decode.pstats', 'smart_decode.txt'])
+        self.assertEqual(sorted(paths), sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)))
+
+    def test_inactive(self):
+        with profiling.stage('insert'):
+            self.assertIsNone(profiling._active)
+        self.assertEqual(list(profiling.iterate('fetch_unseen', [1, 2])), [1, 2])